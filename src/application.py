@@ -28,6 +28,7 @@ from sys import argv
 from .layout_manager import LayoutManagerWindow
 from .preferences import PreferencesWindow
 from .string_manager import StringManagerWindow
+from .global_search import GlobalSearchWindow
 from .window import BadaBibWindow
 
 
@@ -57,6 +58,7 @@ class Application(Adw.Application):
             flags=Gio.ApplicationFlags.HANDLES_OPEN,
             )
         self.window = None
+        self.global_search_window = None
         self.version = version
 
         # Switch to turn customization menu on/off
@@ -143,6 +145,7 @@ class Application(Adw.Application):
             ("cut",             None,                   self.on_cut,            "<Control><Shift>x"),
             ("paste",           None,                   self.on_paste,          "<Control><Shift>v"),
             ("find",            None,                   self.on_find,           "<Control>f"),
+            ("find_all",        None,                   self.on_find_all,       "<Control><Shift>f"),
             ("next_tab",        None,                   self.on_next_tab,       "<Control>Tab"),
             ("prev_tab",        None,                   self.on_prev_tab,       "<Control><Shift>Tab"),
             ("update_bibtex",   None,                   self.on_update_bibtex,  "<Control>Return"),
@@ -341,6 +344,19 @@ class Application(Adw.Application):
         """Handle find signal. See on_quit for parameters."""
         self.window.main_widget.search_itemlist()
 
+    def on_find_all(self, action=None, data=None):
+        """Handle find_all signal. See on_quit for parameters."""
+        # Only one search window, bring it to the front if it is open
+        if self.global_search_window is None:
+            self.global_search_window = GlobalSearchWindow(self.window)
+            self.global_search_window.connect("destroy", self.on_global_search_destroyed)
+        else:
+            self.global_search_window.present()
+
+    def on_global_search_destroyed(self, _window):
+        """Forget the closed search window, so that the next search opens a new one."""
+        self.global_search_window = None
+
     def on_goto(self, action=None, data=None):
         """Handle goto signal. See on_quit for parameters."""
         self.window.main_widget.on_goto_clicked()
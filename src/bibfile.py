@@ -14,15 +14,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from os import fstat
+from os import pread
 from os.path import split
 
-from unicodedata import normalize
-
-from .customization import convert_to_unicode
+from .customization import unicode_to_ascii
 
 from .config_manager import get_default_entrytype
 
 from .bibitem import BadaBibItem
+from .bibitem import rebind_strings
+
+from .scanner import hash_block
+
+from .search_index import SearchIndex
+
+from .loader import decode
+from .loader import parse_entry
 
 
 # 'a' and 'A' to create unique keys by iterating over ASCII characters
@@ -38,7 +46,7 @@ class BadaBibFile:
     Representation of a .bib file and its entries. BadaBibFiles wrap around a
     bibtexparser database and are managed by a BadaBibStore.
     """
-    def __init__(self, store, name, database, created=False):
+    def __init__(self, store, name, database, created=False, sort_values=None, hashes=None):
         """
         Initilize BadaBibFile.
 
@@ -52,6 +60,12 @@ class BadaBibFile:
             bibtexparser database
         created: bool, optional
             Was this file created by BadaBib!? The default value is 'False'.
+        sort_values: list of dict, optional
+            Precomputed sort keys of all entries in the database. The default
+            value is None.
+        hashes: list of bytes, optional
+            Source hashes of all entries in the database. The default value
+            is None.
         """
         self.store = store                          # Store managing this file
         self.name = name                            # Full path
@@ -59,34 +73,316 @@ class BadaBibFile:
         self.base_name = split(name)[1]             # File name, not necesarily unique
         self.database = database                    # bibtexparser database with entries
         self.local_strings = {}                     # Strings defined in the .bib file
+        self.strings_generation = 0                 # Incremented whenever the strings change
         self.writer = store.get_default_writer()    # bibtexparser writer
         self.items = []                             # list of bib items
+        self.entrytype_counts = {}                  # Number of non-deleted items by entry type
+        self.n_deleted = 0                          # Number of deleted items
         self.itemlist = None                        # itemlist showing entries of this file
         self.unsaved = False                        # File contains unsaved changes
         self.created = created                      # File was created by Bada Bib!
         self.backup_on_save = True                  # Backup file when saving
+        self.loading = False                        # File is still being read
+        self.source = None                          # Open .bib file to read scanned entries from
+        self.stamp = None                           # Size and modification time of source
+        self.index = SearchIndex(self)              # Search index, built on first search
 
         # Read database to create items from entries
-        self.read_database()
+        self.read_database(sort_values, hashes)
 
     def unref(self):
         """Delete BadaBibFile to free memory."""
+        self.close_source()
         for item in self.items:
             item.unref()
+        self.items = []
         self.itemlist.unref()
+        self.index.unref()
         self.writer = None
         self.database = None
         self.local_strings = None
         self.itemlist = None
 
-    def read_database(self):
+    def read_database(self, sort_values=None, hashes=None):
         """
         Convert entries of a database to BadaBibItems. This function should only
         be called once on initialization
+
+        Parameters
+        ----------
+        sort_values: list of dict, optional
+            Precomputed sort keys of all entries. The default value is None.
+        hashes: list of bytes, optional
+            Source hashes of all entries. The default value is None.
         """
         self.local_strings = self.database.strings
+        if sort_values is None:
+            sort_values = len(self.database.entries) * [None]
+        if hashes is None:
+            hashes = len(self.database.entries) * [None]
         for idx in range(len(self.database.entries)):
-            self.items.append(BadaBibItem(self, idx))
+            item = BadaBibItem(self, idx, sort_values[idx])
+            item.source_hash = hashes[idx]
+            self.items.append(item)
+            self.update_counts(item.shallow_entry["ENTRYTYPE"], 1)
+
+    def extend_database(self, database, sort_values=None, hashes=None):
+        """
+        Append entries, strings and comments of another database to this file,
+        for example, the next parsed chunk of the file.
+
+        Parameters
+        ----------
+        database: BibDatabase
+            bibtexparser database
+        sort_values: list of dict, optional
+            Precomputed sort keys of all entries. The default value is None.
+        hashes: list of bytes, optional
+            Source hashes of all entries. The default value is None.
+
+        Returns
+        -------
+        items: list of BadaBibItem
+            Items created from the entries of the database
+        """
+        if sort_values is None:
+            sort_values = len(database.entries) * [None]
+        if hashes is None:
+            hashes = len(database.entries) * [None]
+
+        # Let strings refer to the string definitions of this file
+        for value in database.strings.values():
+            rebind_strings(value, self.database)
+        self.local_strings.update(database.strings)
+        self.database.comments.extend(database.comments)
+        self.database.preambles.extend(database.preambles)
+
+        items = []
+        for entry, values, source_hash in zip(database.entries, sort_values, hashes):
+            for value in entry.values():
+                rebind_strings(value, self.database)
+            idx = len(self.database.entries)
+            self.database.entries.append(entry)
+            item = BadaBibItem(self, idx, values)
+            item.source_hash = source_hash
+            items.append(item)
+            self.index.add_item(item)
+            self.update_counts(entry["ENTRYTYPE"], 1)
+        self.items += items
+
+        return items
+
+    def get_source_hashes(self):
+        """
+        Count unmodified items by source hash, see loader.rescan_file.
+
+        Returns
+        -------
+        known: dict
+            Number of items by source hash
+        """
+        known = {}
+        for item in self.items:
+            if item.source_hash is not None:
+                known[item.source_hash] = known.get(item.source_hash, 0) + 1
+        return known
+
+    def update_source_hashes(self):
+        """Hash the source of all items after the file was written, see to_text."""
+        for item in self.items:
+            if item.deleted:
+                item.source_hash = None
+            else:
+                item.source_hash = hash_block(item.bibtex.encode())
+
+    def reload_database(self, database, entries):
+        """
+        Patch this file to match its changed source on disk. Unmodified items
+        whose source did not change are kept as they are, changed items are
+        replaced in place, new items are appended and missing items are
+        deleted.
+
+        Parameters
+        ----------
+        database: BibDatabase
+            Strings, comments and preambles of the file on disk
+        entries: list of (bytes, dict or None)
+            Source hash and entry of all entries on disk. The entry is None if
+            the source is known, see loader.rescan_file.
+
+        Returns
+        -------
+        (list of BadaBibItem, list of BadaBibItem, list of BadaBibItem) or None
+            Changed, new and removed items. None if items were modified while
+            the file was read and the file needs to be reloaded completely.
+        """
+        # Unmodified items by source hash
+        unchanged = {}
+        for item in self.items:
+            if item.source_hash is not None:
+                unchanged.setdefault(item.source_hash, []).append(item)
+
+        # Keep items with known source
+        kept = set()
+        for source_hash, entry in entries:
+            if entry is None:
+                if not unchanged.get(source_hash):
+                    return None
+                kept.add(unchanged[source_hash].pop(0))
+
+        # Remaining items by key, candidates to be replaced by changed entries
+        remaining = {}
+        for item in self.items:
+            if item not in kept:
+                remaining.setdefault(item.shallow_entry["ID"], []).append(item)
+
+        self.local_strings = database.strings
+        for value in self.local_strings.values():
+            rebind_strings(value, self.database)
+        self.database.comments = database.comments
+        self.database.preambles = database.preambles
+
+        changed = []
+        added = []
+        for source_hash, entry in entries:
+            if entry is None:
+                continue
+            for value in entry.values():
+                rebind_strings(value, self.database)
+            if remaining.get(entry["ID"]):
+                item = remaining[entry["ID"]].pop(0)
+                item.update_entry(entry, True)
+                changed.append(item)
+            else:
+                item = self.append_item(entry)
+                added.append(item)
+            item.source_hash = source_hash
+            kept.add(item)
+
+        # Entries that are no longer in the file
+        removed = []
+        for item in self.items:
+            if item not in kept and not item.deleted:
+                item.deleted = True
+                removed.append(item)
+
+        # Entries that were deleted in memory but still exist on disk
+        for item in kept:
+            item.deleted = False
+
+        return changed, added, removed
+
+    def open_source(self, stamp, spans):
+        """
+        Keep the .bib file open to parse scanned entries on demand. The open
+        file still refers to the scanned content if the file is replaced, but
+        not if it is modified in place.
+
+        Parameters
+        ----------
+        stamp: (int, int)
+            Size and modification time of the file when it was scanned
+        spans: list of (int, int)
+            Byte ranges of all entries in the database
+
+        Returns
+        -------
+        bool
+            False if the file changed since it was scanned, True otherwise
+        """
+        try:
+            source = open(self.name, "rb")
+            stat = fstat(source.fileno())
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) != stamp:
+            source.close()
+            return False
+
+        self.source = source
+        self.stamp = stamp
+        for item, span in zip(self.items, spans):
+            item.span = span
+        return True
+
+    def close_source(self):
+        """Close .bib file of scanned entries. Read all entries first, see read_entries."""
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+    def parse_span(self, span):
+        """
+        Parse a scanned entry without replacing it in the database. This can
+        be called in a worker thread.
+
+        Parameters
+        ----------
+        span: (int, int)
+            Byte range of the entry in the file
+
+        Returns
+        -------
+        entry: dict or None
+            Parsed entry, None if the file was modified or closed
+        """
+        # File may be closed by the main thread in the meantime
+        source = self.source
+        if source is None:
+            return None
+
+        start, end = span
+        try:
+            stat = fstat(source.fileno())
+            if (stat.st_size, stat.st_mtime_ns) != self.stamp:
+                return None
+            content = pread(source.fileno(), end - start, start)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            entry = parse_entry(decode(content), self.store.get_parser_settings())
+        except UnicodeDecodeError:
+            return None
+        if entry is None:
+            return None
+        return self.bind_entry(entry)
+
+    def read_entry(self, item):
+        """
+        Parse a scanned entry and replace it in the database.
+
+        Parameters
+        ----------
+        item: BadaBibItem
+            Item of a scanned entry
+
+        Returns
+        -------
+        bool
+            True if the entry was parsed, False if the file was modified
+        """
+        entry = self.parse_span(item.span)
+        if entry is None:
+            return False
+
+        self.database.entries[item.idx] = entry
+
+        item.span = None
+        item.sort_values = {}
+        return True
+
+    def read_entries(self):
+        """
+        Parse all scanned entries, for example, before the file is overwritten.
+
+        Returns
+        -------
+        bool
+            True if all entries were parsed
+        """
+        results = [self.read_entry(item) for item in self.items if item.span is not None]
+        return all(results)
 
     def append_item(self, entry=None):
         """
@@ -112,8 +408,39 @@ class BadaBibFile:
         # Create item from entry and append to list
         item = BadaBibItem(self, idx)
         self.items.append(item)
+        self.index.add_item(item)
+        self.update_counts(item.shallow_entry["ENTRYTYPE"], 1)
         return item
 
+    def set_strings(self, strings):
+        """
+        Set all strings available to this file. Cached pretty text of fields
+        with strings is re-generated, see BadaBibItem.pretty_field.
+
+        Parameters
+        ----------
+        strings: dict
+            Local and global strings
+        """
+        self.database.strings = strings
+        self.strings_generation += 1
+
+    def update_counts(self, entrytype, delta):
+        """
+        Keep the number of non-deleted items by entry type up to date, see
+        count. Items call this if they are deleted, restored or change their
+        entry type.
+
+        Parameters
+        ----------
+        entrytype: str
+            Entry type of item
+        delta: int
+            1 if an item of this type was added or restored, -1 if it was
+            deleted or changed its type
+        """
+        self.entrytype_counts[entrytype] = self.entrytype_counts.get(entrytype, 0) + delta
+
     def count(self, entrytype):
         """
         Count number of non-deleted entries of given type.
@@ -128,7 +455,7 @@ class BadaBibFile:
         int
             Number of non-deleted items of given type
         """
-        return sum(item.entry["ENTRYTYPE"] == entrytype for item in self.items if not item.deleted)
+        return self.entrytype_counts.get(entrytype, 0)
 
     def count_all(self):
         """
@@ -139,7 +466,7 @@ class BadaBibFile:
         int
             Number of non-deleted items
         """
-        return sum(not item.deleted for item in self.items)
+        return len(self.items) - self.n_deleted
 
     def is_empty(self):
         """
@@ -187,7 +514,7 @@ class BadaBibFile:
 
     def has_empty_keys(self):
         """Check if file contains non-deleted entries without keys"""
-        return any(not item.entry["ID"] and not item.deleted for item in self.items)
+        return any(not item.shallow_entry["ID"] and not item.deleted for item in self.items)
 
     def get_duplicate_keys(self):
         """
@@ -198,7 +525,7 @@ class BadaBibFile:
         duplicates: list of str
             List of duplicate keys
         """
-        keys = [item.entry["ID"] for item in self.items if not item.deleted]
+        keys = [item.shallow_entry["ID"] for item in self.items if not item.deleted]
         duplicates = [key for key in set(keys) if keys.count(key) > 1]
         return duplicates
 
@@ -216,7 +543,7 @@ class BadaBibFile:
         bool
             True if key is unique
         """
-        keys = [item.entry["ID"] for item in self.items if not item.deleted]
+        keys = [item.shallow_entry["ID"] for item in self.items if not item.deleted]
         return keys.count(key) == 0
 
     def generate_key_for_item(self, item):
@@ -234,15 +561,14 @@ class BadaBibFile:
             Unique entry key
         """
         # Get last name of first author, covert to ascii, and capitalize.
-        # If the paper has exactly two authors, get both last names
+        # If the paper has exactly two authors, get both last names. Names
+        # are taken from the pretty author field and already unicode.
         last_names = item.last_name_list()
         if "author" in item.entry and last_names:
-            utf_name = convert_to_unicode(last_names[0])
-            ascii_name = normalize("NFKD", utf_name).encode("ascii", "ignore").decode("utf-8")
+            ascii_name = unicode_to_ascii(last_names[0])
             key = ascii_name[:1].upper() + ascii_name[1:]
             if len(last_names) == 2:
-                utf_name = convert_to_unicode(last_names[1])
-                ascii_name = normalize("NFKD", utf_name).encode("ascii", "ignore").decode("utf-8")
+                ascii_name = unicode_to_ascii(last_names[1])
                 key += ascii_name[:1].upper() + ascii_name[1:]
         else:
             # use entrytpye as key otherwise
@@ -270,54 +596,44 @@ class BadaBibFile:
 
         return key
 
-    @staticmethod
-    def get_sort_key_func(field):
+    def parse_entry(self, bibtex):
         """
-        Wrap sort key of item in a function so that it can be passed to the
-        list.sort() method.
+        Parse a single bibtex entry with default parser.
 
         Parameters
         ----------
-        fields: str
-            Field of interest
+        bibtex: str
+            Raw BibTeX entry
 
         Returns
         -------
-        sort_key_func: function
-            sort key function
+        dict or None
+            bibparser database entry or None, if bibtex parameter is invalid
         """
-        def sort_key_func(item):
-            return item.sort_values[field]
-        return sort_key_func
+        # Macros are parsed whether they are defined or not. They are resolved
+        # by binding the entry to the strings of this file, so there is no
+        # need to parse all string definitions along with the entry.
+        entry = parse_entry(bibtex, self.store.get_parser_settings())
+        if entry is None:
+            return None
+        return self.bind_entry(entry)
 
-    def parse_entry(self, bibtex):
+    def bind_entry(self, entry):
         """
-        Parse a single bibtex entry with default parser.
+        Let strings in an entry that was parsed on its own refer to the string
+        definitions of this file.
 
         Parameters
         ----------
-        bibtex: str
-            Raw BibTeX entry
+        entry: dict
 
         Returns
         -------
-        dict or None
-            bibparser database entry or None, if bibtex parameter is invalid
+        entry: dict
         """
-        parser = self.store.get_default_parser()
-        writer = self.store.get_default_writer()
-
-        # add strings to bibtex entry and try to parse it
-        strings_and_bibtex = writer._strings_to_bibtex(self.database) + bibtex
-        try:
-            test_database = parser.parse(strings_and_bibtex)
-        except UnicodeDecodeError:
-            return None
-
-        # we expect a database with a single entry
-        if test_database and len(test_database.entries) == 1:
-            return test_database.entries.pop(-1)
-        return None
+        for value in entry.values():
+            rebind_strings(value, self.database)
+        return entry
 
     def comments_to_text(self):
         """
@@ -365,16 +681,10 @@ class BadaBibFile:
         text = ""
 
         # Sort by order of itemlist
-        sort_key_func = self.get_sort_key_func(self.itemlist.sort_key)
-        self.items.sort(reverse=self.itemlist.sort_reverse, key=sort_key_func)
-
-        for item in self.items:
+        for item in self.itemlist.get_sorted_items():
             # Only write non-deleted items
             if not item.deleted:
-                # If setting is active, align along '=' sign
-                if self.writer.align_values:
-                    self.writer._max_field_width = item.max_field_width
-                text += self.writer._entry_to_bibtex(item.entry)
+                text += item.bibtex
 
         return text
 
@@ -14,6 +14,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from gi.repository import GObject
+
 from bibtexparser.latexenc import latex_to_unicode
 
 from bibtexparser.bibdatabase import BibDatabase
@@ -38,6 +40,11 @@ month_database.strings = month_dict
 # maximum char to sort entries to the end of a list
 MAX_CHAR = chr(0x10FFFF)
 
+# Sort keys that are generated from a field, see get_sort_value
+sort_sources = {field: (field,) for field in sort_fields}
+sort_sources["booktitle"] = ("journal",)
+sort_sources["date"] = ("year",)
+
 
 def expand_pretty(expression):
     """
@@ -85,6 +92,47 @@ def expand_raw(expression):
     return text
 
 
+def get_pretty_text(entry, field):
+    """
+    Get pretty text in a field of an entry.
+
+    Parameters
+    ----------
+    entry: dict
+    field: str
+
+    Returns
+    -------
+    text: str or None
+        Pretty text, None if field does not exist
+    """
+    if field not in entry:
+        return None
+    text = expand_pretty(entry[field])                  # Expand strings
+    text = latex_to_unicode(text)                       # Convert to unicode
+    return prettify_unicode_field(field, text)          # Prettify
+
+
+def get_raw_text(entry, field):
+    """
+    Get raw text in a field of an entry, see expand_raw.
+
+    Parameters
+    ----------
+    entry: dict
+    field: str
+
+    Returns
+    -------
+    text: str or None
+        Raw text, None if field does not exist
+    """
+    value = entry.get(field)
+    if isinstance(value, BibDataStringExpression):
+        return expand_raw(value)
+    return value
+
+
 def get_n_strings_expr(expression):
     """
     Get number of strings contained in expression. Does count undefined
@@ -164,6 +212,23 @@ def text_to_expression(text, database):
     return BibDataStringExpression(expr_list)
 
 
+def rebind_strings(value, database):
+    """
+    Let all strings in an expression refer to the string definitions of the
+    given database. Needed when moving entries between databases, for example
+    when merging parsed chunks of a file.
+
+    Parameters
+    ----------
+    value: str or BibDataStringExpression
+    database: BibDatabase
+    """
+    if isinstance(value, BibDataStringExpression):
+        for expr in value.expr:
+            if isinstance(expr, BibDataString):
+                expr._bibdatabase = database
+
+
 def entries_equal(entry1, entry2):
     """
     Check if two entries are identical. Strings are expanded for this
@@ -189,12 +254,149 @@ def entries_equal(entry1, entry2):
     return True
 
 
-class BadaBibItem:
+def get_last_names(entry, pretty=None):
+    """
+    Get list of last names in the author field of an entry.
+
+    Parameters
+    ----------
+    entry: dict
+    pretty: function, optional
+        Returns the pretty text of a field of entry, for example, from the
+        cache of an item, see BadaBibItem.pretty_field. If None, the text is
+        generated. The default value is None.
+
+    Returns
+    -------
+    last_name_list: list of str
+    """
+    # Check that author field exists
+    if "author" not in entry:
+        return []
+
+    # Expand and prittify author field
+    value = pretty("author") if pretty else get_pretty_text(entry, "author")
+    if not value:
+        return []
+
+    # remove line breaks and split names along "and"
+    clean_value = value.replace("\n", " ").replace("\\", "")
+    name_list = [name.strip() for name in clean_value.split(" and ")]
+    names = getnames(name_list)
+
+    # Extract last names, ignore if no last name is defined
+    last_name_list = []
+    for name in names:
+        try:
+            name_parts = splitname(name)["last"]
+            name_str = " ".join(name_parts)
+            last_name_list.append(name_str)
+        except InvalidName:
+            pass
+
+    return last_name_list
+
+
+def get_lowercase_last_names(entry, pretty=None):
+    """
+    String all lower case last name together. This is used as a sort key
+    when ordering the itenlist.
+
+    Parameters
+    ----------
+    entry: dict
+    pretty: function, optional
+        Returns the pretty text of a field, see get_last_names
+
+    Returns
+    -------
+    last_name_str: str
+    """
+    last_name_list = get_last_names(entry, pretty)
+    last_name_str = ""
+    for last_name in last_name_list:
+        for part in last_name:
+            last_name_str += part.lower().strip(" ()[]{}")
+    return last_name_str
+
+
+def get_sort_value(entry, field, pretty=None):
+    """
+    Generate the sort key of an entry for a given field.
+
+    Parameters
+    ----------
+    entry: dict
+    field: str
+    pretty: function, optional
+        Returns the pretty text of a field, see get_last_names
+
+    Returns
+    -------
+    value: str
+    """
+    if field == "author":
+        # Sort by lower case last names
+        if "author" in entry:
+            value = get_lowercase_last_names(entry, pretty)
+        else:
+            # Sort to end of list if auther is not defined
+            value = MAX_CHAR
+    else:
+        # If "journal" is not defiend, try "booktitle"
+        if field == "journal" and "journal" not in entry:
+            _field_ = "booktitle"
+        # If "year" is not defined, try "date"
+        elif field == "year" and "year" not in entry:
+            _field_ = "date"
+        else:
+            _field_ = field
+
+        if _field_ in entry:
+            # If field exists, sort by lower case pretty value
+            if pretty:
+                value = pretty(_field_).lower()
+            else:
+                value = get_pretty_text(entry, _field_).lower()
+        else:
+            # Sort to end of list otherwise
+            value = MAX_CHAR
+
+    # Catch existing but empty fields
+    if not value:
+        value = MAX_CHAR
+
+    return value
+
+
+def get_sort_values(entry, fields=None):
+    """
+    Generate the sort keys of an entry for the given fields.
+
+    Parameters
+    ----------
+    entry: dict
+    fields: iterable of str, optional
+        Fields to generate sort keys for. If None, generate sort keys for all
+        fields in the itemlist sort menu. The default value is None.
+
+    Returns
+    -------
+    dict
+        Sort keys by field
+    """
+    if fields is None:
+        fields = sort_fields
+    return {field: get_sort_value(entry, field) for field in fields}
+
+
+class BadaBibItem(GObject.Object):
     """
     Representation of a BibTeX entry. BadaBibItems wrap around a
-    bibtexparser entry and are managed by a BadaBibFile.
+    bibtexparser entry and are managed by a BadaBibFile. They are GObjects,
+    so that they can be shown by list models.
     """
-    def __init__(self, bibfile, idx):
+    def __init__(self, bibfile, idx, sort_values=None):
         """
         Initilize BadaBibItem.
 
@@ -204,22 +406,66 @@ class BadaBibItem:
             File this entry belongs to
         idx: int
             Index of this entry in the database of the bibfile
+        sort_values: dict, optional
+            Precomputed sort keys, for example, read from the cache. Missing
+            sort keys are generated on demand. The default value is None.
         """
+        super().__init__()
         self.bibfile = bibfile
         self.idx = idx
-        self.row = None             # Row of itemlist containing this entry
-        self.sort_values = {}       # Sort keys of this entry
-        self.bibtex = None          # Raw BibTeX source
-        self.deleted = False        # True if entry was deleted
-
-        self.update_bibtex()            # Generate source
-        self.update_all_sort_values()   # Generate sort keys
+        self.row = None             # Row of itemlist showing this entry, if visible
+        self.sort_values = {}       # Sort keys of this entry, filled lazily
+        self.sort_tuple = None      # Composite sort key, see get_sort_tuple
+        self.sort_tuple_fields = ()
+        self.row_markup = {}        # Markup of row labels by source fields, see Row.get_markup
+        self.pretty_values = {}     # Pretty text by field, see pretty_field
+        self.raw_values = {}        # Raw text of fields with strings, see raw_field
+        self.strings_generation = bibfile.strings_generation
+        self._bibtex = None         # Raw BibTeX source, generated lazily
+        self._deleted = False       # True if entry was deleted
+        self.span = None            # Byte range in file, if entry was scanned but not parsed
+        self.source_hash = None     # Hash of source in file, None if entry was modified
+
+        if sort_values is not None:
+            self.sort_values = sort_values
 
     @property
     def entry(self):
-        """Shortcut to entry in database"""
+        """Shortcut to entry in database, parse scanned entries on first access"""
+        if self.span is not None:
+            self.bibfile.read_entry(self)
+        return self.bibfile.database.entries[self.idx]
+
+    @property
+    def deleted(self):
+        """True if entry was deleted"""
+        return self._deleted
+
+    @deleted.setter
+    def deleted(self, deleted):
+        # Keep entry counts of file up to date
+        if deleted != self._deleted:
+            self._deleted = deleted
+            delta = -1 if deleted else 1
+            self.bibfile.n_deleted -= delta
+            self.bibfile.update_counts(self.shallow_entry["ENTRYTYPE"], delta)
+
+    @property
+    def shallow_entry(self):
+        """Entry in database without parsing. Scanned entries only contain ID and type."""
         return self.bibfile.database.entries[self.idx]
 
+    @property
+    def bibtex(self):
+        """Raw BibTeX source, generated on first access"""
+        if self._bibtex is None:
+            writer = self.bibfile.writer
+            # Align fields along '=' if setting is active
+            if writer.align_values:
+                writer._max_field_width = self.max_field_width
+            self._bibtex = writer._entry_to_bibtex(self.entry)
+        return self._bibtex
+
     @property
     def max_field_width(self):
         """Length of longest field name except entry type"""
@@ -230,7 +476,24 @@ class BadaBibItem:
         self.bibfile = None
         self.row = None
         self.sort_values = None
-        self.bibtex = None
+        self.sort_tuple = None
+        self.row_markup = {}
+        self.pretty_values = {}
+        self.raw_values = {}
+        self._bibtex = None
+
+    def prewarm(self):
+        """Fill the caches of all fields, for example, in idle time after loading."""
+        for field in self.entry:
+            self.pretty_field(field)
+            self.raw_field(field)
+
+    def forget_strings(self):
+        """Drop the cached pretty text of fields with strings, see pretty_field."""
+        self.strings_generation = self.bibfile.strings_generation
+        for field in list(self.pretty_values):
+            if isinstance(self.shallow_entry.get(field), BibDataStringExpression):
+                self.pretty_values.pop(field, None)
 
     def pretty_field(self, field):
         """
@@ -244,15 +507,64 @@ class BadaBibItem:
         -------
         str
         """
-        # Check if field exists in this entry
-        if field not in self.entry:
-            return None
+        # Expanded strings are outdated if the strings of the file changed
+        if self.strings_generation != self.bibfile.strings_generation:
+            self.forget_strings()
+        try:
+            return self.pretty_values[field]
+        except KeyError:
+            pass
+
+        # Key and type are known without parsing scanned entries
+        if field in ("ID", "ENTRYTYPE"):
+            entry = self.shallow_entry
+        else:
+            entry = self.entry
+
+        value = get_pretty_text(entry, field)
 
-        value = expand_pretty(self.entry[field])        # Expand strings
-        value = latex_to_unicode(value)                 # Convert to unicode
-        value = prettify_unicode_field(field, value)    # Prettify
+        # Fields of entries that could not be parsed are not cached
+        if self.span is None or field in ("ID", "ENTRYTYPE"):
+            self.pretty_values[field] = value
         return value
 
+    def peek_entry(self):
+        """
+        Get a copy of the entry without modifying this item, for example, in
+        the search thread. Scanned entries are parsed, but not kept.
+
+        Returns
+        -------
+        entry: dict
+        """
+        span = self.span
+        if span is not None:
+            entry = self.bibfile.parse_span(span)
+            if entry is not None:
+                return entry
+        return dict(self.shallow_entry)
+
+    def peek_pretty_field(self, entry, field):
+        """
+        Get pretty text in given field of a copy of the entry, see peek_entry.
+        Cached text is used, but nothing is cached, so that the caches are
+        only ever written by the main thread.
+
+        Parameters
+        ----------
+        entry: dict
+        field: str
+
+        Returns
+        -------
+        str
+        """
+        if self.strings_generation == self.bibfile.strings_generation:
+            value = self.pretty_values.get(field)
+            if value is not None:
+                return value
+        return get_pretty_text(entry, field)
+
     def raw_field(self, field):
         """
         Get raw text in given field.
@@ -270,9 +582,13 @@ class BadaBibItem:
             return None
 
         # Mark strings if necessary, return raw text otherwise
-        if isinstance(self.entry[field], BibDataStringExpression):
-            return expand_raw(self.entry[field])
-        return self.entry[field]
+        value = self.entry[field]
+        if isinstance(value, BibDataStringExpression):
+            text = self.raw_values.get(field)
+            if text is None:
+                text = self.raw_values[field] = expand_raw(value)
+            return text
+        return value
 
     def bibstring_status(self, field):
         """
@@ -309,49 +625,7 @@ class BadaBibItem:
         -------
         last_name_list: list of str
         """
-        # Check that author field exists
-        if "author" not in self.entry:
-            return []
-
-        # Expand and prittify author field
-        value = expand_pretty(self.entry["author"])
-        value = latex_to_unicode(value)
-        value = prettify_unicode_field("author", value)
-        if not value:
-            return []
-
-        # remove line breaks and split names along "and"
-        clean_value = value.replace("\n", " ").replace("\\", "")
-        name_list = [name.strip() for name in clean_value.split(" and ")]
-        names = getnames(name_list)
-
-        # Extract last names, ignore if no last name is defined
-        last_name_list = []
-        for name in names:
-            try:
-                name_parts = splitname(name)["last"]
-                name_str = " ".join(name_parts)
-                last_name_list.append(name_str)
-            except InvalidName:
-                pass
-
-        return last_name_list
-
-    def lowercase_last_names(self):
-        """
-        String all lower case last name together. This is used as a sort key
-        when ordering the itenlist.
-
-        Returns
-        -------
-        last_name_str: str
-        """
-        last_name_list = self.last_name_list()
-        last_name_str = ""
-        for last_name in last_name_list:
-            for part in last_name:
-                last_name_str += part.lower().strip(" ()[]{}")
-        return last_name_str
+        return get_last_names(self.entry, self.pretty_field)
 
     def update_field(self, field, value, update_bibtex=True):
         """
@@ -362,8 +636,12 @@ class BadaBibItem:
         field: str
         value: str or BibDataStringExpression
         update_bibtex: bool
-            If True, regenerate the raw BibTeX source
+            If True, invalidate the raw BibTeX source
         """
+        if field == "ENTRYTYPE":
+            self.update_entrytype_count(-1)
+        old_value = self.entry.get(field)
+
         # Case: BibTeX key is changed
         if field == "ID":
             # BibTeX key field is not allowed to contain strings
@@ -386,9 +664,29 @@ class BadaBibItem:
         elif field in self.entry:
             self.entry.pop(field)
 
-        # Update sort key, if sort field was changed
-        if field in sort_fields:
-            self.update_sort_value(field)
+        if field == "ENTRYTYPE":
+            self.update_entrytype_count(1)
+
+        # Entry no longer matches its source in the file
+        self.source_hash = None
+
+        # Invalidate cached text and row markup generated from this field. Values
+        # with strings are re-rendered, since their definition may have changed.
+        new_value = self.entry.get(field)
+        if not isinstance(new_value, str) or new_value != old_value:
+            self.pretty_values.pop(field, None)
+            self.raw_values.pop(field, None)
+            for fields in [fields for fields in self.row_markup if field in fields]:
+                del self.row_markup[fields]
+
+        # Invalidate sort keys generated from this field
+        for sort_field in sort_sources.get(field, ()):
+            self.sort_values.pop(sort_field, None)
+            if sort_field in self.sort_tuple_fields:
+                self.sort_tuple = None
+
+        # Keep search index up to date
+        self.bibfile.index.update_field(self, field)
 
         # Update BibTeX source
         if update_bibtex:
@@ -396,9 +694,15 @@ class BadaBibItem:
 
     def refresh(self):
         """Re-read all fields of entry. Useful if strings are defined or deleted."""
+        # Scanned entries use the current strings once they are parsed
+        if self.span is not None:
+            return
+        # Re-reading does not modify the entry
+        source_hash = self.source_hash
         entry = self.entry.copy()
         for field, value in entry.items():
             self.update_field(field, value, update_bibtex=False)
+        self.source_hash = source_hash
 
     def update_entry(self, entry, update_bibtex=False):
         """
@@ -413,59 +717,72 @@ class BadaBibItem:
             If True, update BibTeX source. This is typically not required since
             the user directly modified the source already.
         """
+        self.update_entrytype_count(-1)
         self.bibfile.database.entries[self.idx] = entry
-        self.update_all_sort_values()
+        self.update_entrytype_count(1)
+        self.span = None
+        self.source_hash = None
+        self.sort_values = {}
+        self.sort_tuple = None
+        self.row_markup = {}
+        self.pretty_values = {}
+        self.raw_values = {}
+        self.bibfile.index.update_item(self)
         if update_bibtex:
             self.update_bibtex()
 
+    def update_entrytype_count(self, delta):
+        # Deleted items are not counted, see BadaBibFile.count
+        if not self.deleted:
+            self.bibfile.update_counts(self.shallow_entry.get("ENTRYTYPE"), delta)
+
     def update_bibtex(self):
-        """Regenerate BibTeX source for entry."""
-        writer = self.bibfile.writer
-        # Align fields along '=' if setting is active
-        if writer.align_values:
-            writer._max_field_width = self.max_field_width
-        self.bibtex = writer._entry_to_bibtex(self.entry)
-
-    def update_sort_value(self, field):
+        """Invalidate BibTeX source for entry. It is regenerated on next access."""
+        self._bibtex = None
+
+    def get_sort_value(self, field):
         """
-        Regenerate the sort key for a given field.
+        Get the sort key for a given field, generate it if necessary.
 
         Parameters
         ----------
         field: str
+
+        Returns
+        -------
+        value: str
         """
-        if field == "author":
-            # Sort by lower case last names
-            if "author" in self.entry:
-                self.sort_values["author"] = self.lowercase_last_names()
-            else:
-                # Sort to end of list if auther is not defined
-                self.sort_values["author"] = MAX_CHAR
-        else:
-            # If "journal" is not defiend, try "booktitle"
-            if field == "journal" and "journal" not in self.entry:
-                _field_ = "booktitle"
-            # If "year" is not defined, try "date"
-            elif field == "year" and "year" not in self.entry:
-                _field_ = "date"
-            else:
-                _field_ = field
-
-            if _field_ in self.entry:
-                # If field exists, sort by lower case pretty value
-                value = expand_pretty(self.entry[_field_])
-                value = latex_to_unicode(value)
-                value = prettify_unicode_field(_field_, value).lower()
-                self.sort_values[field] = value
+        try:
+            return self.sort_values[field]
+        except KeyError:
+            # Sorting by key does not require parsing scanned entries
+            if field == "ID":
+                value = get_sort_value(self.shallow_entry, field, self.pretty_field)
             else:
-                # Sort to end of list otherwise
-                self.sort_values[field] = MAX_CHAR
+                value = get_sort_value(self.entry, field, self.pretty_field)
+            self.sort_values[field] = value
+            return value
 
-        # Catch existing but empty fields
-        if not self.sort_values[field]:
-            self.sort_values[field] = MAX_CHAR
+    def get_sort_tuple(self, fields):
+        """
+        Get the composite sort key for the given fields, generate it if
+        necessary. The key is kept until one of the fields is modified.
+
+        Parameters
+        ----------
+        fields: tuple of str
 
-    def update_all_sort_values(self):
-        """Update sort key for all fields in itemlist sort menu."""
-        for field in sort_fields:
-            self.update_sort_value(field)
+        Returns
+        -------
+        sort_tuple: tuple
+            (False,) for entries without BibTeX key, so that these come first.
+            Otherwise True followed by the sort keys of the fields.
+        """
+        if self.sort_tuple is None or self.sort_tuple_fields != fields:
+            if self.shallow_entry["ID"]:
+                values = [self.get_sort_value(field) for field in fields]
+                self.sort_tuple = (True, *values)
+            else:
+                self.sort_tuple = (False,)
+            self.sort_tuple_fields = fields
+        return self.sort_tuple
@@ -0,0 +1,252 @@
+# cache.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pickle
+
+from os import environ
+from os import getpid
+from os import makedirs
+from os import remove
+from os import replace
+from os import scandir
+from os import utime
+from os.path import abspath
+from os.path import exists
+from os.path import expanduser
+from os.path import join
+
+from time import time
+
+from hashlib import blake2b
+
+
+# Increase whenever the layout of cached data changes
+CACHE_VERSION = 3
+
+# Least recently used cache files are removed above this total size, in bytes
+MAX_CACHE_SIZE = 256 * 2**20
+
+# Temporary files older than this were left behind by crashed writers, in s
+TMP_FILE_AGE = 3600
+
+
+def get_cache_dir():
+    """
+    Get directory of the parse cache, following the XDG base directory
+    specification.
+
+    Returns
+    -------
+    str
+    """
+    cache_home = environ.get("XDG_CACHE_HOME") or expanduser("~/.cache")
+    return join(cache_home, "badabib")
+
+
+def get_cache_file(name, kind=None):
+    """
+    Get name of the cache file of a .bib file.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    kind: str, optional
+        Kind of cached data, if the file is cached in more than one way. The
+        default value is None, which refers to the parsed file.
+
+    Returns
+    -------
+    str
+    """
+    digest = blake2b(abspath(name).encode(), digest_size=16).hexdigest()
+    if kind:
+        digest += "." + kind
+    return join(get_cache_dir(), digest + ".pickle")
+
+
+def get_cache_key(name, stat, content, homogenize_latex, homogenize_fields):
+    """
+    Create key that identifies a parsed .bib file. A cached database is only
+    valid if all parts of the key match.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    stat: os.stat_result
+        Status of the .bib file
+    content: bytes
+        Content of the .bib file
+    homogenize_latex, homogenize_fields: bool
+        Parser settings
+
+    Returns
+    -------
+    tuple
+    """
+    return (
+        CACHE_VERSION,
+        abspath(name),
+        stat.st_size,
+        stat.st_mtime_ns,
+        blake2b(content).hexdigest(),
+        homogenize_latex,
+        homogenize_fields,
+    )
+
+
+def get_strings_cache_key(name, stat, homogenize_latex, homogenize_fields):
+    """
+    Create key that identifies the string definitions of a .bib file. Unlike
+    get_cache_key, the content is not hashed, so that checking the key only
+    costs a call to stat.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    stat: os.stat_result
+        Status of the .bib file
+    homogenize_latex, homogenize_fields: bool
+        Parser settings
+
+    Returns
+    -------
+    tuple
+    """
+    return (
+        CACHE_VERSION,
+        abspath(name),
+        stat.st_size,
+        stat.st_mtime_ns,
+        homogenize_latex,
+        homogenize_fields,
+    )
+
+
+def load(name, key, kind=None):
+    """
+    Load cached data of a .bib file.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    key: tuple
+        Cache key, see get_cache_key
+    kind: str, optional
+        Kind of cached data, see get_cache_file
+
+    Returns
+    -------
+    data or None
+        Cached data or None, if there is no valid cache for this key
+    """
+    try:
+        with open(get_cache_file(name, kind), "rb") as cache_file:
+            if pickle.load(cache_file) != key:
+                return None
+            data = pickle.load(cache_file)
+        # Mark cache file as recently used, see prune
+        utime(get_cache_file(name, kind))
+        return data
+    # Missing, corrupt or outdated cache files are cache misses
+    except Exception:
+        return None
+
+
+def save(name, key, data, kind=None):
+    """
+    Write data of a .bib file to the cache. The cache file is replaced
+    atomically, so that concurrent readers never see partial files.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    key: tuple
+        Cache key, see get_cache_key
+    data: any picklable object
+        Data to be cached
+    kind: str, optional
+        Kind of cached data, see get_cache_file
+    """
+    cache_file = get_cache_file(name, kind)
+    tmp_file = f"{cache_file}.{getpid()}.tmp"
+    try:
+        makedirs(get_cache_dir(), exist_ok=True)
+        with open(tmp_file, "wb") as file:
+            pickle.dump(key, file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, file, pickle.HIGHEST_PROTOCOL)
+        replace(tmp_file, cache_file)
+    except (OSError, pickle.PicklingError):
+        # Caching is optional, clean up and carry on
+        try:
+            remove(tmp_file)
+        except OSError:
+            pass
+    prune()
+
+
+def get_cached_name(cache_file):
+    # Cache keys start with the version and the path of the .bib file
+    try:
+        with open(cache_file, "rb") as file:
+            return pickle.load(file)[1]
+    except Exception:
+        return None
+
+
+def prune():
+    """
+    Remove cache files of .bib files that no longer exist, temporary files of
+    crashed writers, and the least recently used cache files if the cache
+    grows beyond MAX_CACHE_SIZE. Cache files of a .bib file are replaced
+    whenever it changes, see get_cache_file, so there is at most one of each
+    kind per file.
+    """
+    try:
+        entries = list(scandir(get_cache_dir()))
+    except OSError:
+        return
+
+    cache_files = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+            if entry.name.endswith(".tmp"):
+                if time() - stat.st_mtime > TMP_FILE_AGE:
+                    remove(entry.path)
+            elif entry.name.endswith(".pickle"):
+                name = get_cached_name(entry.path)
+                if name is None or not exists(name):
+                    remove(entry.path)
+                else:
+                    cache_files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            continue
+
+    # Remove least recently used files first
+    total_size = sum(size for _, size, _ in cache_files)
+    for _, size, path in sorted(cache_files):
+        if total_size <= MAX_CACHE_SIZE:
+            break
+        try:
+            remove(path)
+        except OSError:
+            continue
+        total_size -= size
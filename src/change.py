@@ -16,6 +16,8 @@
 
 from time import time
 
+from gi.repository import Gtk
+
 from .config_manager import get_undo_delay
 
 
@@ -39,7 +41,7 @@ class Change:
         """
         @property
         def main_widget(self):
-            window = self.item.row.get_root()
+            window = self.bibfile.itemlist.get_root()
             return window.main_widget
 
         @property
@@ -108,12 +110,11 @@ class Change:
                 True if change is applied via redo action. The default value
                 is False.
             """
-            self.item.row.update_field(self.form.field)     # Itemlist row
+            self.bibfile.itemlist.update_item(self.item)    # Itemlist row
             self.source_view.update(self.item)              # Source view
             self.form.update(self.item)                     # Editor form
             if redo:
-                self.bibfile.itemlist.unselect_all()
-                self.bibfile.itemlist.select_row(self.item.row)
+                self.bibfile.itemlist.select_item(self.item, True)
                 self.main_widget.focus_on_current_item()
 
     class Show(Generic):
@@ -141,27 +142,25 @@ class Change:
                 item.deleted = False
 
             # Re-apply filter to show new/undeleted items
-            self.bibfile.itemlist.invalidate_filter()
+            self.bibfile.itemlist.invalidate_filter(Gtk.FilterChange.LESS_STRICT)
 
             # Select all new/undeleted items
-            self.bibfile.itemlist.unselect_all()
-            for item in self.items:
-                self.bibfile.itemlist.select_row(item.row)
+            self.bibfile.itemlist.set_selected_items(self.items)
             self.main_widget.focus_on_current_item()
 
         def revert(self):
             """Delete/hide item"""
+            position = self.bibfile.itemlist.get_position(self.item)
+
             # Mark item as deleted
             for item in self.items:
                 item.deleted = True
 
             # Re-apply filter to hide deleted items
-            self.bibfile.itemlist.invalidate_filter()
+            self.bibfile.itemlist.invalidate_filter(Gtk.FilterChange.MORE_STRICT)
 
             # Select item next to deleted one, or clear editor and source view
-            self.bibfile.itemlist.unselect_all()
-            next_row = self.bibfile.itemlist.select_next_row(self.item.row)
-            if next_row:
+            if position is not None and self.bibfile.itemlist.select_position(position):
                 self.main_widget.focus_on_current_item()
             else:
                 self.editor.clear()
@@ -199,25 +198,23 @@ class Change:
         def apply(self, redo=False):
             """Apply change. See Edit class for details on redo parameter."""
             self.item.update_entry(self.new_entry, True)    # Update entry
-            self.item.row.update()                          # Update itemlist row
+            self.bibfile.itemlist.update_item(self.item)    # Update itemlist row
             self.editor.show_item(self.item)                # Show new item in editor
             if redo:
                 # Update source view (only needed on redo, otherwise edited by
                 # user) and select changed entry in itemlist.
                 self.source_view.update(self.item)
-                self.bibfile.itemlist.unselect_all()
-                self.bibfile.itemlist.select_row(self.item.row)
+                self.bibfile.itemlist.select_item(self.item, True)
                 self.main_widget.focus_on_current_item()
 
         def revert(self):
             """Restore the previous entry."""
             # Update entry, editor, source view, selection and focus
             self.item.update_entry(self.old_entry, True)
-            self.item.row.update()
+            self.bibfile.itemlist.update_item(self.item)
             self.editor.show_item(self.item)
             self.source_view.update(self.item)
-            self.bibfile.itemlist.unselect_all()
-            self.bibfile.itemlist.select_row(self.item.row)
+            self.bibfile.itemlist.select_item(self.item, True)
             self.main_widget.focus_on_current_item()
 
 
@@ -14,6 +14,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from unicodedata import normalize
+
 from bibtexparser.latexenc import latex_to_unicode
 from bibtexparser.latexenc import string_to_latex
 
@@ -112,6 +114,11 @@ def prettify_unicode_field(field, value):
     return prettify_unicode_string(value)
 
 
+def unicode_to_ascii(value):
+    """Remove accents and drop all other non-ASCII characters."""
+    return normalize("NFKD", value).encode("ascii", "ignore").decode("utf-8")
+
+
 # Costumizations that can be applied to fields. All functions take parameters
 # of the form (str, dict, int) and return a str.
 
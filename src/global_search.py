@@ -0,0 +1,179 @@
+# global_search.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from gi.repository import Gtk, GLib, Pango
+
+from .search_index import SearchCancelled
+
+
+# Number of results that are shown
+MAX_RESULTS = 200
+
+# Wait before searching again if files were modified while searching, in ms
+RETRY_DELAY = 150
+
+
+class ResultRow(Gtk.ListBoxRow):
+    def __init__(self, item):
+        super().__init__()
+        self.item = item
+
+        key = item.shallow_entry["ID"] or "(no key)"
+        key_label = Gtk.Label(xalign=0, hexpand=True)
+        key_label.set_markup(f"<b>{GLib.markup_escape_text(key)}</b>")
+
+        # Badge with name of file
+        file_label = Gtk.Label(label=item.bibfile.short_name or item.bibfile.base_name)
+        file_label.add_css_class("caption")
+        file_label.add_css_class("accent")
+        file_label.set_tooltip_text(item.bibfile.name)
+
+        title_label = Gtk.Label(xalign=0, label=item.pretty_field("title") or "")
+        author_label = Gtk.Label(xalign=0, label=item.pretty_field("author") or "")
+        author_label.add_css_class("dim-label")
+        for label in (title_label, author_label):
+            label.set_ellipsize(Pango.EllipsizeMode.END)
+
+        header = Gtk.Box(spacing=10)
+        header.append(key_label)
+        header.append(file_label)
+
+        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=2)
+        vbox.set_margin_top(6)
+        vbox.set_margin_bottom(6)
+        vbox.set_margin_start(10)
+        vbox.set_margin_end(10)
+        vbox.append(header)
+        vbox.append(title_label)
+        vbox.append(author_label)
+        self.set_child(vbox)
+
+
+class GlobalSearchWindow(Gtk.Window):
+    def __init__(self, main_window):
+        super().__init__(transient_for=main_window, destroy_with_parent=True,
+                         title="Search All Files")
+        self.main_widget = main_window.main_widget
+        self.store = self.main_widget.store
+        self.search_future = None       # Running search
+        self.search_version = 0         # Incremented whenever the query changes
+
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_tooltip_text("Search all fields, or single fields like\n"
+                                           "author:smith year:2018..2021 type:article\n"
+                                           "Add ~ to also find similar words, like schrodnger~")
+        self.search_entry.set_margin_top(6)
+        self.search_entry.set_margin_bottom(6)
+        self.search_entry.set_margin_start(6)
+        self.search_entry.set_margin_end(6)
+        self.search_entry.connect("search_changed", self.on_search_changed)
+        self.search_entry.connect("activate", self.on_search_activated)
+
+        self.result_list = Gtk.ListBox()
+        self.result_list.connect("row-activated", self.on_row_activated)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_vexpand(True)
+        scrolled_window.set_child(self.result_list)
+
+        self.status_label = Gtk.Label()
+        self.status_label.add_css_class("dim-label")
+        self.status_label.set_margin_top(4)
+        self.status_label.set_margin_bottom(4)
+
+        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        vbox.append(self.search_entry)
+        vbox.append(Gtk.Separator())
+        vbox.append(scrolled_window)
+        vbox.append(Gtk.Separator())
+        vbox.append(self.status_label)
+        self.set_child(vbox)
+
+        self.connect("close-request", self.on_close_request)
+        self.set_default_size(600, 700)
+        self.present()
+
+    def on_close_request(self, _window):
+        self.cancel_search()
+        return False
+
+    def cancel_search(self):
+        self.search_version += 1
+        if self.search_future:
+            self.search_future.cancel()
+            self.search_future = None
+
+    def on_search_changed(self, _search_entry=None):
+        # Search entry already waits for the user to stop typing
+        self.cancel_search()
+        query = self.search_entry.get_text()
+        if not query.strip():
+            self.show_results([], 0)
+            return
+
+        version = self.search_version
+
+        def is_cancelled():
+            return version != self.search_version
+
+        self.status_label.set_text("Searching...")
+        self.search_future = self.store.search_all_files(query, MAX_RESULTS, is_cancelled)
+        self.search_future.add_done_callback(
+            lambda future: GLib.idle_add(self.search_finalize, future, version))
+
+    def search_finalize(self, future, version):
+        # Drop results of superseded searches
+        if version != self.search_version or future.cancelled():
+            return
+        self.search_future = None
+
+        try:
+            items, n_matches = future.result()
+        except SearchCancelled:
+            # Files were modified while searching, try again
+            GLib.timeout_add(RETRY_DELAY, self.retry_search, version)
+            return
+        self.show_results(items, n_matches)
+
+    def retry_search(self, version):
+        if version == self.search_version:
+            self.on_search_changed()
+        return GLib.SOURCE_REMOVE
+
+    def show_results(self, items, n_matches):
+        row = self.result_list.get_row_at_index(0)
+        while row:
+            self.result_list.remove(row)
+            row = self.result_list.get_row_at_index(0)
+        for item in items:
+            self.result_list.append(ResultRow(item))
+
+        if not self.search_entry.get_text().strip():
+            self.status_label.set_text("")
+        elif n_matches > len(items):
+            self.status_label.set_text(f"Showing {len(items)} of {n_matches} entries")
+        else:
+            self.status_label.set_text(f"{n_matches} entries found")
+
+    def on_search_activated(self, _search_entry):
+        row = self.result_list.get_row_at_index(0)
+        if row:
+            self.on_row_activated(self.result_list, row)
+
+    def on_row_activated(self, _result_list, row):
+        # File may have been closed in the meantime
+        if row.item.bibfile is None or row.item.bibfile.itemlist is None:
+            return
+        self.main_widget.show_item(row.item)
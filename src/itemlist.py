@@ -14,14 +14,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from gi.repository import Gtk, Gdk, Gio, Adw
+from gi.repository import Gtk, Gdk, Gio, GLib, Adw
 
 from os.path import split
 
+from bisect import bisect_left
+
+from .bibitem import BadaBibItem
+
+from .search_index import SearchCancelled
+from .search_index import parse_query
+from .search_index import is_refinement
+
 from .change import ChangeBuffer
 
 from .config_manager import entrytype_dict
 from .config_manager import link_fields
+from .config_manager import sort_fields
 from .config_manager import get_row_indent
 
 
@@ -29,8 +38,8 @@ row_indent = get_row_indent() * " "
 
 entrytypes = list(entrytype_dict.keys()) + ["other"]
 
-MIN_MAX_CHAR = ('', chr(0x10FFFF))
-ROW_HEIGHT = 95
+# Wait for the user to stop typing before searching, in ms
+SEARCH_DELAY = 150
 
 
 class ItemlistTabView(Gtk.Box):
@@ -81,6 +90,7 @@ class ItemlistPage(Gtk.Box):
         self.empty_bar = ItemlistInfoBar("File does not contain any BibTeX entries.")
         self.backup_bar = ItemlistInfoBar("<b>Bada Bib! was unable to create a backup file!</b>\nTry deleting or renaming any .bak-files that were not created by Bada Bib!")
         self.save_bar = ItemlistInfoBar("<b>File could not be saved!</b>\nYou might not have write permissions for this file or folder.")
+        self.loading_bar = ItemlistInfoBar("File is still loading.\nSave it again once all entries are shown.")
         self.changed_bar = ItemlistChangedBar()
         self.searchbar = ItemlistSearchBar()
 
@@ -103,6 +113,7 @@ class ItemlistPage(Gtk.Box):
         self.append(self.empty_bar)
         self.append(self.backup_bar)
         self.append(self.save_bar)
+        self.append(self.loading_bar)
         self.append(self.changed_bar)
         self.append(self.scrolled_window)
         self.append(self.searchbar)
@@ -114,6 +125,7 @@ class ItemlistPage(Gtk.Box):
         self.remove(self.empty_bar)
         self.remove(self.backup_bar)
         self.remove(self.save_bar)
+        self.remove(self.loading_bar)
         self.remove(self.changed_bar)
         self.remove(self.scrolled_window)
         self.remove(self.searchbar)
@@ -136,6 +148,10 @@ class ItemlistPage(Gtk.Box):
         self.append(self.center_box)
 
     def show_error_screen(self, status):
+        # Itemlist might have been shown already if loading failed midway
+        if self.center_box.get_parent() is None:
+            self.append(self.center_box)
+
         if "file_error" in status:
             message = "Cannot open file.\nFile might have been moved or deleted."
         elif "parse_error" in status:
@@ -178,10 +194,13 @@ class ItemlistInfoBar(Gtk.InfoBar):
         self.show_text(True)
         self.set_revealed(True)
 
+    def conceal(self):
+        self.set_revealed(False)
+        self.show_text(False)
+
     def on_response(self, infobar, response):
         if response == Gtk.ResponseType.CLOSE:
-            self.set_revealed(False)
-            self.show_text(False)
+            self.conceal()
 
 
 class ItemlistChangedBar(Gtk.InfoBar):
@@ -221,6 +240,9 @@ class ItemlistSearchBar(Gtk.SearchBar):
     def __init__(self):
         super().__init__()
         self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_tooltip_text("Search all fields, or single fields like\n"
+                                           "author:smith year:2018..2021 type:article\n"
+                                           "Add ~ to also find similar words, like schrodnger~")
         self.set_child(self.search_entry)
         self.connect_entry(self.search_entry)
 
@@ -268,11 +290,10 @@ class ItemlistToolbar(Gtk.CenterBox):
         center_box.prepend(self.goto_button)
 
 
-class Row(Gtk.ListBoxRow):
-    def __init__(self, item):
+class Row(Gtk.Box):
+    def __init__(self):
         super().__init__()
-        self.set_activatable(False)
-        self.item = item
+        self.item = None
 
         self.id_label = Gtk.Label(xalign=0)
         self.author_label = Gtk.Label(xalign=0)
@@ -284,7 +305,6 @@ class Row(Gtk.ListBoxRow):
         self.link_image.set_margin_start(10)
 
         self.assemble()
-        self.update()
 
     def assemble(self):
         self.idbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
@@ -299,14 +319,16 @@ class Row(Gtk.ListBoxRow):
         self.vbox.append(self.journal_label)
         self.vbox.append(self.publisher_label)
 
-        self.set_child(self.vbox)
+        self.append(self.vbox)
+
+    def bind(self, item):
+        self.item = item
+        item.row = self
+        self.update()
 
-    def disassemble(self):
-        self.vbox.remove(self.idbox)
-        self.vbox.remove(self.author_label)
-        self.vbox.remove(self.title_label)
-        self.vbox.remove(self.journal_label)
-        self.vbox.remove(self.publisher_label)
+    def unbind(self):
+        if self.item:
+            self.item.row = None
         self.item = None
 
     def update(self):
@@ -328,53 +350,74 @@ class Row(Gtk.ListBoxRow):
         elif field in link_fields:
             self.update_link()
 
+    def get_markup(self, fields, render):
+        # Markup is kept by the item until one of the fields is modified
+        markup = self.item.row_markup.get(fields)
+        if markup is None:
+            markup = self.item.row_markup[fields] = render(self.item)
+        return markup
+
     def update_id(self):
-        label = row_indent
-        if "ID" in self.item.entry:
-            label += self.item.entry["ID"]
-        label = f"""<b>{label}</b> ({self.item.pretty_field("ENTRYTYPE")})"""
-        self.id_label.set_markup(label)
-        self.changed()
+        self.id_label.set_markup(self.get_markup(("ID", "ENTRYTYPE"), self.render_id))
 
     def update_author(self):
+        self.author_label.set_markup(self.get_markup(("author", "editor"), self.render_author))
+
+    def update_title(self):
+        self.title_label.set_markup(self.get_markup(("title",), self.render_title))
+
+    def update_journal(self):
+        self.journal_label.set_markup(self.get_markup(("journal", "booktitle"), self.render_journal))
+
+    def update_publisher(self):
+        self.publisher_label.set_markup(self.get_markup(("publisher", "year"), self.render_publisher))
+
+    @staticmethod
+    def render_id(item):
         label = row_indent
-        if "author" in self.item.entry:
-            label += self.item.pretty_field("author")
-        if "editor" in self.item.entry:
+        if "ID" in item.shallow_entry:
+            label += item.shallow_entry["ID"]
+        return f"""<b>{label}</b> ({item.pretty_field("ENTRYTYPE")})"""
+
+    @staticmethod
+    def render_author(item):
+        label = row_indent
+        if "author" in item.entry:
+            label += item.pretty_field("author")
+        if "editor" in item.entry:
             if label != row_indent:
                 label += ", "
-            label += f"""Ed: {self.item.pretty_field("editor")}"""
-        self.author_label.set_markup(label)
-        self.changed()
+            label += f"""Ed: {item.pretty_field("editor")}"""
+        return label
 
-    def update_title(self):
+    @staticmethod
+    def render_title(item):
         label = row_indent
-        if "title" in self.item.entry:
-            label += self.item.pretty_field("title")
-        self.title_label.set_markup(label)
-        self.changed()
+        if "title" in item.entry:
+            label += item.pretty_field("title")
+        return label
 
-    def update_journal(self):
+    @staticmethod
+    def render_journal(item):
         label = row_indent
-        if "journal" in self.item.entry:
-            label += f"""<i>{self.item.pretty_field("journal")}</i>"""
-        if "booktitle" in self.item.entry:
+        if "journal" in item.entry:
+            label += f"""<i>{item.pretty_field("journal")}</i>"""
+        if "booktitle" in item.entry:
             if label != row_indent:
                 label += ", "
-            label += f"""<i>{self.item.pretty_field("booktitle")}</i>"""
-        self.journal_label.set_markup(label)
-        self.changed()
+            label += f"""<i>{item.pretty_field("booktitle")}</i>"""
+        return label
 
-    def update_publisher(self):
+    @staticmethod
+    def render_publisher(item):
         label = row_indent
-        if "publisher" in self.item.entry:
-            label += self.item.pretty_field("publisher")
-        if "year" in self.item.entry:
+        if "publisher" in item.entry:
+            label += item.pretty_field("publisher")
+        if "year" in item.entry:
             if label != row_indent:
                 label += ", "
-            label += self.item.pretty_field("year")
-        self.publisher_label.set_markup(label)
-        self.changed()
+            label += item.pretty_field("year")
+        return label
 
     def update_link(self):
         if set(link_fields) & set(self.item.entry.keys()):
@@ -383,26 +426,58 @@ class Row(Gtk.ListBoxRow):
             self.link_image.clear()
 
 
-class Itemlist(Gtk.ListBox):
+class Itemlist(Gtk.ListView):
+    """
+    List of the items of a file. Only rows of visible items exist, they are
+    recycled while scrolling. Items are kept sorted in the list store and
+    filtered by the model between the list store and the selection.
+    """
     def __init__(self, bibfile, state_string=None, change_buffer=None):
         super().__init__()
         self.bibfile = bibfile
         self.page = None
         self.focus_idx = 0
 
-        self.set_selection_mode(Gtk.SelectionMode.MULTIPLE)
-        self.set_activate_on_single_click(False)
-
-        self.sort_key = "ID"
-        self.sort_reverse = False
+        # Sort fields and whether they are descending, in order of priority
+        self.sort_keys = [("ID", False)]
+        self.sort_fields = ()
+        self.sort_directions = ()
         self.search_string = ""
+        self.search_terms = []              # Terms of search string of matches
+        self.search_matches = None          # Items matching search string, None if empty
+        self.search_generation = None       # Generation of search index for matches
+        self.search_timeout = None          # Pending search
+        self.search_future = None           # Running search
+        self.search_version = 0             # Incremented whenever matches are outdated
         self.fltr = {entrytype: True for entrytype in entrytypes}
 
         if state_string:
             self.string_to_state(state_string)
-
-        self.set_sort_func(self.sort_by_field)
-        self.set_filter_func(self.filter_and_unselect)
+        self.update_sort_fields()
+
+        # Items sorted by the first sort key in ascending order and by all
+        # other keys relative to it. The list store holds the same items in
+        # the order shown, see get_sorted_items.
+        self.order = []
+
+        # list store -> filter -> selection
+        self.model = Gio.ListStore(item_type=BadaBibItem)
+        self.custom_filter = Gtk.CustomFilter.new(self.filter_item)
+        self.filter_model = Gtk.FilterListModel(model=self.model, filter=self.custom_filter)
+        self.selection = Gtk.MultiSelection(model=self.filter_model)
+
+        # Position of each visible item, rebuilt on demand after the visible
+        # items changed, see get_position
+        self.visible_positions = None
+        self.visible_handler = self.filter_model.connect("items-changed",
+                                                         self.on_visible_items_changed)
+        self.set_model(self.selection)
+
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self.on_setup_row)
+        factory.connect("bind", self.on_bind_row)
+        factory.connect("unbind", self.on_unbind_row)
+        self.set_factory(factory)
 
         self.set_show_separators(True)
 
@@ -419,19 +494,33 @@ class Itemlist(Gtk.ListBox):
         else:
             self.change_buffer = ChangeBuffer()
 
-        self.add_rows(bibfile.items)
+        self.add_items(bibfile.items)
 
     def unref(self):
-        while True:
-            row = self.get_row_at_index(0)
-            if not row:
-                break
-            row.disassemble()
-            self.remove(row)
+        self.cancel_search()
+        # Detach view first, so that clearing the model does not update rows
+        self.set_model(None)
+        self.filter_model.disconnect(self.visible_handler)
+        self.model.remove_all()
+        self.order = []
+        self.visible_positions = None
+        self.search_matches = None
         self.page = None
         self.bibfile = None
         self.change_buffer = None
 
+    @staticmethod
+    def on_setup_row(_factory, list_item):
+        list_item.set_child(Row())
+
+    @staticmethod
+    def on_bind_row(_factory, list_item):
+        list_item.get_child().bind(list_item.get_item())
+
+    @staticmethod
+    def on_unbind_row(_factory, list_item):
+        list_item.get_child().unbind()
+
     def update_filename(self, unsaved=False, name=None):
         if name:
             base_name = split(name)[1]
@@ -452,162 +541,422 @@ class Itemlist(Gtk.ListBox):
             self.page.deleted_bar.set_revealed(False)
             self.change_buffer.update_saved_state()
 
-    def add_row(self, item):
-        row = Row(item)
-        self.append(row)
-        item.row = row
-        return row
+    @property
+    def sort_key(self):
+        return self.sort_keys[0][0]
+
+    @property
+    def sort_reverse(self):
+        return self.sort_keys[0][1]
+
+    def update_sort_fields(self):
+        # Ties are broken by key, in the direction of the first sort key
+        fields = [field for field, _ in self.sort_keys]
+        directions = [reverse != self.sort_reverse for _, reverse in self.sort_keys]
+        if "ID" not in fields:
+            fields.append("ID")
+            directions.append(False)
+
+        # First value of a sort tuple tells whether entry has a key
+        self.sort_fields = tuple(fields)
+        self.sort_directions = (False, *directions)
+
+    def get_sort_tuple(self, item):
+        return item.get_sort_tuple(self.sort_fields)
+
+    def comes_before(self, sort_tuple1, sort_tuple2):
+        for value1, value2, reverse in zip(sort_tuple1, sort_tuple2, self.sort_directions):
+            if value1 != value2:
+                return value1 > value2 if reverse else value1 < value2
+        return False
+
+    def get_insert_index(self, item):
+        # Bisect for the index after all items that do not come after item
+        sort_tuple = self.get_sort_tuple(item)
+        low, high = 0, len(self.order)
+        while low < high:
+            mid = (low + high) // 2
+            if self.comes_before(sort_tuple, self.get_sort_tuple(self.order[mid])):
+                high = mid
+            else:
+                low = mid + 1
+        return low
 
-    def add_rows(self, items):
-        for item in items:
-            self.add_row(item)
-
-    def get_next_row(self, row, increment):
-        while row:
-            index = row.get_index()
-            row = self.get_row_at_index(index + increment)
-            if row and self.filter(row):
-                return row
-        return None
+    def get_n_unkeyed(self):
+        # Entries without key are at the start of the sort order
+        return bisect_left(self.order, True, key=lambda item: self.get_sort_tuple(item)[0])
 
-    def select_next_row(self, row):
-        # get next row...
-        next_row = self.get_next_row(row, 1)
-        if not next_row:
-            next_row = self.get_next_row(row, -1)
+    def get_sorted_items(self):
+        # Reverse order by flipping it, entries without key stay on top
+        if self.sort_reverse:
+            n_unkeyed = self.get_n_unkeyed()
+            return self.order[:n_unkeyed] + self.order[n_unkeyed:][::-1]
+        return list(self.order)
+
+    def get_display_position(self, index, n_unkeyed):
+        # Position in list store of item at index of the sort order
+        if self.sort_reverse and index >= n_unkeyed:
+            return n_unkeyed + len(self.order) - 1 - index
+        return index
+
+    def apply_order(self):
+        # Replace all items at once, so that the selection is kept
+        self.model.splice(0, self.model.get_n_items(), self.get_sorted_items())
+
+    def sort_items(self, items):
+        if any(self.sort_directions):
+            # Sort by one field after another, starting with the last one.
+            # Ties keep the order of the previous sort since sort is stable.
+            for n in range(len(self.sort_fields), 0, -1):
+                items.sort(key=lambda item, n=n: self.get_sort_tuple(item)[n:n + 1],
+                           reverse=self.sort_directions[n])
+            items.sort(key=lambda item: self.get_sort_tuple(item)[0])
+        else:
+            items.sort(key=self.get_sort_tuple)
+
+    def invalidate_sort(self):
+        self.sort_items(self.order)
+        self.apply_order()
+
+    def set_sort_keys(self, sort_keys):
+        sort_fields = self.sort_fields
+        sort_directions = self.sort_directions
+
+        # Each field is used once
+        self.sort_keys = []
+        for field, reverse in sort_keys:
+            if field not in [key[0] for key in self.sort_keys]:
+                self.sort_keys.append((field, reverse))
+        self.update_sort_fields()
+
+        # Flipping the order does not require comparing any items
+        if self.sort_fields == sort_fields and self.sort_directions == sort_directions:
+            self.apply_order()
+        else:
+            self.invalidate_sort()
 
-        # ...and select it
-        if next_row:
-            self.select_row(next_row)
-            return next_row
+    def set_sort_key(self, field):
+        self.set_sort_keys([(field, self.sort_reverse)] + self.sort_keys[1:])
 
-        # ...or unselect all and return None
-        self.unselect_all()
-        return None
+    def set_sort_reverse(self, reverse):
+        self.set_sort_keys([(self.sort_key, reverse)] + self.sort_keys[1:])
+
+    def add_items(self, items):
+        self.update_search()
+        if not self.order:
+            self.order = list(items)
+            self.invalidate_sort()
+            return
+
+        # Find the place of each new item in the sort order. New items go
+        # after existing items they tie with, so sorted items have ascending
+        # places.
+        items = list(items)
+        self.sort_items(items)
+        indices = [self.get_insert_index(item) for item in items]
+
+        # Insert items that go to the same place at once, starting at the end
+        stop = len(items)
+        for n in range(len(items) - 1, -1, -1):
+            if n == 0 or indices[n - 1] != indices[n]:
+                self.order[indices[n]:indices[n]] = items[n:stop]
+                stop = n
+
+        # Insert each run of adjacent new rows with a single splice, in the
+        # order shown, so that rows before a run are already in place
+        n_unkeyed = self.get_n_unkeyed()
+        rows = sorted((self.get_display_position(index + n, n_unkeyed), item)
+                      for n, (index, item) in enumerate(zip(indices, items)))
+        start = 0
+        for n in range(1, len(rows) + 1):
+            if n == len(rows) or rows[n][0] != rows[n - 1][0] + 1:
+                self.model.splice(rows[start][0], 0, [item for _, item in rows[start:n]])
+                start = n
+
+    def update_item(self, item):
+        self.update_search()
+
+        # Move item to its new place in the sort order
+        self.order.remove(item)
+        index = self.get_insert_index(item)
+        self.order.insert(index, item)
+
+        found, old_position = self.model.find(item)
+        if not found:
+            return
+        new_position = self.get_display_position(index, self.get_n_unkeyed())
+
+        # Replace the item in place, so that it is re-filtered and rebound.
+        # The selection keeps items that are removed and added in one go.
+        if new_position == old_position:
+            self.model.splice(old_position, 1, [item])
+            return
+
+        # Otherwise move only this item, so that no other rows are filtered
+        # or rebound, and select it again at its new position
+        selected = item in self.get_selected_items()
+        positions = []
+        handler = self.filter_model.connect(
+            "items-changed",
+            lambda _model, position, _removed, added: positions.append(position) if added else None)
+        self.model.remove(old_position)
+        self.model.insert(new_position, item)
+        self.filter_model.disconnect(handler)
+        if selected and positions:
+            self.selection.select_item(positions[0], False)
+
+    def count_visible(self):
+        # Number of rows that pass search and filter
+        return self.filter_model.get_n_items()
+
+    def on_visible_items_changed(self, _model, _position, _removed, _added):
+        self.visible_positions = None
+
+    def get_position(self, item):
+        # Sorting, filtering and searching touch all items anyway, so the
+        # positions are rebuilt once afterwards instead of being maintained
+        if self.visible_positions is None:
+            self.visible_positions = {self.filter_model.get_item(position): position
+                                      for position in range(self.filter_model.get_n_items())}
+        return self.visible_positions.get(item)
+
+    def select_item(self, item, unselect_rest=False):
+        position = self.get_position(item)
+        if position is not None:
+            self.selection.select_item(position, unselect_rest)
+
+    def get_positions_bitset(self, items):
+        positions = Gtk.Bitset.new_empty()
+        for item in items:
+            position = self.get_position(item)
+            if position is not None:
+                positions.add(position)
+        return positions
+
+    def set_selected_items(self, items):
+        # Replace the selection at once, with a single signal
+        positions = self.get_positions_bitset(items)
+        mask = Gtk.Bitset.new_range(0, self.selection.get_n_items())
+        self.selection.set_selection(positions, mask)
+
+    def select_position(self, position):
+        # Select item at position or the last item, if position is out of range
+        n_items = self.selection.get_n_items()
+        if n_items == 0:
+            self.unselect_all()
+            return False
+        self.selection.select_item(min(position, n_items - 1), True)
+        return True
+
+    def unselect_all(self):
+        self.selection.unselect_all()
 
     def focus_on_selected_items(self, idx=None):
         if self.bibfile is None:
             return
 
-        items = self.get_selected_items()
-        if items:
+        positions = self.get_selected_positions()
+        if positions:
             if idx is None:
-                self.focus_idx = (self.focus_idx + 1) % len(items)
+                self.focus_idx = (self.focus_idx + 1) % len(positions)
                 idx = self.focus_idx
-            row = items[idx].row
-            preceeding_rows = 0
-            while row := self.get_next_row(row, -1):
-                preceeding_rows += 1
-            self.get_adjustment().set_value(preceeding_rows * ROW_HEIGHT)
+            self.scroll_to(positions[idx], Gtk.ListScrollFlags.NONE, None)
 
-    def reselect_rows(self, rows=None, adj=None):
+    def reselect_items(self, items=None, adj=None):
         if self.bibfile is None:
             return
 
-        if rows is None:
-            rows = self.get_selected_rows()
-        self.unselect_all()
-        for row in rows:
-            if self.filter(row):
-                self.select_row(row)
+        if items is None:
+            items = self.get_selected_items()
+        self.set_selected_items(items)
         if adj is not None:
-            self.get_adjustment().set_value(adj)
+            self.get_vadjustment().set_value(adj)
+
+    def count_selected(self):
+        return self.selection.get_selection().get_size()
+
+    def get_selected_positions(self):
+        bitset = self.selection.get_selection()
+        return [bitset.get_nth(n) for n in range(bitset.get_size())]
 
     def get_selected_items(self):
-        return [row.item for row in self.get_selected_rows()]
+        return [self.selection.get_item(position) for position in self.get_selected_positions()]
 
     def refresh(self):
-        index = 0
-        while True:
-            row = self.get_row_at_index(index)
-            if not row:
-                break
-            row.item.refresh()
-            row.update()
-            index += 1
-        self.reselect_rows()
+        for item in self.bibfile.items:
+            item.refresh()
+        items = self.get_selected_items()
+        self.update_search()
+        # Sort values may have changed, re-sort and rebind all rows
+        self.invalidate_sort()
+        self.reselect_items(items)
+
+    def invalidate_filter(self, change=Gtk.FilterChange.DIFFERENT):
+        self.custom_filter.changed(change)
 
     def set_search_string(self, search_entry):
         self.search_string = search_entry.get_text()
-        self.invalidate_filter()
-
-    def sort_by_field(self, row1, row2):
-        items = (row1.item, row2.item)
-        values = [0, 0]
-
-        for n, item in enumerate(items):
-            # sort entries without ID to the top, irrespective of sort order
-            if item.entry["ID"]:
-                values[n] = item.sort_values[self.sort_key]
-            else:
-                values[n] = MIN_MAX_CHAR[self.sort_reverse]
-
-        # fall back to ID if ordering is ambigious
-        if values[0] == values[1] and values[0] not in MIN_MAX_CHAR:
-            values = [items[0].sort_values["ID"], items[1].sort_values["ID"]]
-
-        comp = 1 if values[0] >= values[1] else -1
-
-        if self.sort_reverse:
-            return -comp
-
-        return comp
-
-    def filter_and_unselect(self, row):
-        visible = self.filter(row)
-        if row.is_selected() and not visible:
-            self.unselect_row(row)
-        return visible
-
-    def filter(self, row):
-        search = self.search_string.lower()
-        item = row.item
+        # Matches of the same terms stay valid, unless items were modified
+        # since and a refresh is pending
+        if (parse_query(self.search_string) == self.search_terms
+                and self.search_generation == self.bibfile.index.generation):
+            self.cancel_search()
+        else:
+            self.schedule_search()
+
+    def cancel_search(self):
+        # Supersede pending and running searches
+        self.search_version += 1
+        if self.search_timeout:
+            GLib.source_remove(self.search_timeout)
+            self.search_timeout = None
+        if self.search_future:
+            self.search_future.cancel()
+            self.search_future = None
+
+    def schedule_search(self):
+        self.cancel_search()
+        # Search in worker thread once the user stops typing
+        self.search_timeout = GLib.timeout_add(SEARCH_DELAY, self.search_async)
+
+    def update_search(self):
+        # Items were modified, update matches of current search
+        if self.search_matches is not None:
+            self.schedule_search()
+
+    def search_async(self):
+        self.search_timeout = None
+        terms = parse_query(self.search_string)
+        if not terms:
+            self.apply_search_matches(terms, None)
+            return GLib.SOURCE_REMOVE
+
+        # Narrow down previous matches if possible
+        index = self.bibfile.index
+        candidates = None
+        if (self.search_matches is not None and self.search_generation == index.generation
+                and is_refinement(self.search_terms, terms)):
+            candidates = self.search_matches
+
+        version = self.search_version
+        generation = index.generation
+
+        def is_cancelled():
+            return version != self.search_version
+
+        self.search_future = self.bibfile.store.search_file(self.bibfile, self.search_string,
+                                                            candidates, is_cancelled)
+        self.search_future.add_done_callback(
+            lambda future: GLib.idle_add(self.search_finalize, future, terms, version,
+                                         generation))
+        return GLib.SOURCE_REMOVE
+
+    def search_finalize(self, future, terms, version, generation):
+        # Drop results of superseded searches
+        if version != self.search_version or future.cancelled() or self.bibfile is None:
+            return
+        self.search_future = None
+
+        try:
+            matches = future.result()
+        except SearchCancelled:
+            # Items were modified while searching, try again
+            matches = None
+        if matches is None or generation != self.bibfile.index.generation:
+            self.schedule_search()
+            return
+        self.apply_search_matches(terms, matches)
+
+    def reveal_item(self, item):
+        # Clear search and entry type filter if they hide item
+        if self.search_matches is not None and item not in self.search_matches:
+            self.page.searchbar.search_entry.set_text("")
+            self.search_string = ""
+            self.cancel_search()
+            self.apply_search_matches([], None)
+
+        entrytype = item.shallow_entry["ENTRYTYPE"]
+        if entrytype not in self.fltr:
+            entrytype = "other"
+        if not self.fltr[entrytype]:
+            self.fltr[entrytype] = True
+            self.invalidate_filter(Gtk.FilterChange.LESS_STRICT)
+
+    def apply_search_matches(self, terms, matches):
+        old_matches = self.search_matches
+        self.search_terms = terms
+        self.search_matches = matches
+        self.search_generation = self.bibfile.index.generation
+
+        # Only visible rows need to be filtered again if matches were narrowed
+        # down, and only hidden rows if they were widened
+        if old_matches is None and matches is None:
+            return
+        if old_matches is None or (matches is not None and matches <= old_matches):
+            self.invalidate_filter(Gtk.FilterChange.MORE_STRICT)
+        elif matches is None or matches >= old_matches:
+            self.invalidate_filter(Gtk.FilterChange.LESS_STRICT)
+        else:
+            self.invalidate_filter()
 
+    def filter_item(self, item, _data=None):
         if item.deleted:
             return False
-        if item.entry["ENTRYTYPE"] not in self.fltr:
+        entry = item.shallow_entry
+        if entry["ENTRYTYPE"] not in self.fltr:
             return self.fltr["other"]
-        if not self.fltr[item.entry["ENTRYTYPE"]]:
+        if not self.fltr[entry["ENTRYTYPE"]]:
             return False
-        if not item.entry["ID"]:
+        if not entry["ID"]:
             return True
 
-        # poor man's fuzzy search
-        phrases = search.split('"')
-        quoted = [False]
-        for phrase in phrases[1:]:
-            quoted.append(not quoted[-1])
-        if len(phrases) % 2 == 0:
-            quoted[-1] = False
-
-        for phrase, protected in filter(None, zip(phrases, quoted)):
-            if protected:
-                words = [phrase]
-            else:
-                words = phrase.split()
-            for word in words:
-                for field in item.entry:
-                    if word in item.raw_field(field).lower():
-                        break
-                    if word in item.pretty_field(field).lower():
-                        break
-                else:
-                    return False
-        return True
+        return self.search_matches is None or item in self.search_matches
 
     def state_to_string(self):
-        string = f"{self.sort_key}|{self.sort_reverse}"
+        # Sort fields separated by commas, further fields marked descending by '-'
+        fields = [self.sort_key]
+        for field, reverse in self.sort_keys[1:]:
+            fields.append(f"-{field}" if reverse else field)
+        string = f"{','.join(fields)}|{self.sort_reverse}"
         for value in self.fltr.values():
             string += f"|{value}"
         return string
 
+    @staticmethod
+    def sort_fields_from_string(text):
+        """
+        Get the sort fields from a state string without creating an itemlist.
+
+        Parameters
+        ----------
+        text: str or None
+            State string, see state_to_string
+
+        Returns
+        -------
+        tuple of str
+        """
+        if text:
+            values = text.split("|")
+            if len(values) >= 2:
+                fields = [field.lstrip("-") for field in values[0].split(",")]
+                return tuple(field for field in fields if field in sort_fields) or ("ID",)
+        return ("ID",)
+
     def string_to_state(self, text):
         values = text.split("|")
         if len(values) < 2:
             return
 
-        self.sort_key = values.pop(0)
-        self.sort_reverse = values.pop(0) == "True"
+        # Unknown fields, for example from a newer version, are dropped
+        fields = values.pop(0).split(",")
+        reverse = values.pop(0) == "True"
+        if fields[0] in sort_fields:
+            self.sort_keys = [(fields[0], reverse)]
+        for field in fields[1:]:
+            name = field.lstrip("-")
+            if name in sort_fields and name not in [key[0] for key in self.sort_keys]:
+                self.sort_keys.append((name, field.startswith("-")))
         for entrytype in entrytypes:
             if values:
                 value = values.pop(0)
@@ -0,0 +1,541 @@
+# loader.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Functions in this module are executed in the worker processes of the
+# store's executor. They must not create or touch any widgets. Parser
+# settings are passed explicitly by the caller, since workers must not rely
+# on GSettings, even though importing the sort key helpers of bibitem loads
+# config_manager and thus GSettings in each worker.
+
+
+import pickle
+
+from os import fstat
+
+from threading import local
+
+from mmap import mmap
+from mmap import ACCESS_READ
+
+from bibtexparser.bparser import BibTexParser
+from bibtexparser.bibdatabase import BibDatabase
+from bibtexparser.customization import homogenize_latex_encoding
+
+from . import cache
+
+from .bibitem import get_sort_values
+from .bibitem import rebind_strings
+
+from .scanner import NON_ENTRY_TYPES
+from .scanner import find_blocks
+from .scanner import find_string_blocks
+from .scanner import find_top_level_blocks
+from .scanner import hash_block
+from .scanner import scan_blocks
+from .scanner import split_chunks
+
+
+# Files are parsed in chunks of roughly this many bytes. The first chunk is
+# smaller, so that the first entries can be shown as quickly as possible.
+FIRST_CHUNK_SIZE = 2**16
+CHUNK_SIZE = 2**18
+
+# Parsers for single entries by settings, see parse_entry. Entries are also
+# parsed in the main process, by the main thread and the search thread, so
+# each thread uses its own parsers.
+entry_parsers = local()
+
+# Files of at least this many bytes are scanned instead of parsed. Entries of
+# scanned files are parsed on demand, see BadaBibFile.read_entry.
+SCAN_SIZE = 2**26
+
+
+class Chunk:
+    """Byte range of a .bib file that can be parsed by a worker process."""
+    def __init__(self, name, stamp, start, end, strings, settings, sort_fields):
+        """
+        Initialize Chunk.
+
+        Parameters
+        ----------
+        name: str
+            Full path of the .bib file
+        stamp: (int, int)
+            Size and modification time of the file when it was split
+        start, end: int
+            Byte range of the chunk
+        strings: dict
+            All string definitions of the file. Used to generate sort keys
+            of entries that use strings defined in other chunks.
+        settings: (bool, bool)
+            Parser settings, see get_parser
+        sort_fields: tuple of str
+            Fields to generate sort keys for
+        """
+        self.name = name
+        self.stamp = stamp
+        self.start = start
+        self.end = end
+        self.strings = strings
+        self.settings = settings
+        self.sort_fields = sort_fields
+
+
+def get_parser(homogenize_latex, homogenize_fields):
+    """
+    Create a bibtexparser parser with the given settings.
+
+    Parameters
+    ----------
+    homogenize_latex: bool
+        Convert LaTeX to canonical form
+    homogenize_fields: bool
+        Unify field names
+
+    Returns
+    -------
+    parser: BibTexParser
+    """
+    parser = BibTexParser(interpolate_strings=False,
+                          ignore_nonstandard_types=False)
+    if homogenize_latex:
+        parser.customization = homogenize_latex_encoding
+    if homogenize_fields:
+        parser.homogenize_fields = True
+    return parser
+
+
+def parse_text(parser, text):
+    """
+    Parse text into a new database. Unlike BibTexParser.parse, this can be
+    called repeatedly on the same parser, which saves setting up the grammar
+    for every call.
+
+    Parameters
+    ----------
+    parser: BibTexParser
+    text: str
+
+    Returns
+    -------
+    database: BibDatabase
+    """
+    parser.expect_multiple_parse = True
+    parser.bib_database = BibDatabase()
+    if parser.common_strings:
+        parser.bib_database.load_common_strings()
+    return parser.parse(text)
+
+
+def parse_entry(bibtex, settings):
+    """
+    Parse a single entry. Setting up the grammar dominates the cost of
+    parsing a single entry, so parsers are reused, one per thread. Macros
+    in the entry are parsed whether they are defined or not and need to be
+    bound to the strings of a file, see rebind_strings.
+
+    Parameters
+    ----------
+    bibtex: str
+        Raw BibTeX entry
+    settings: (bool, bool)
+        Parser settings, see get_parser
+
+    Returns
+    -------
+    dict or None
+        bibtexparser entry or None, if bibtex is not a single valid entry
+    """
+    parsers = getattr(entry_parsers, "parsers", None)
+    if parsers is None:
+        parsers = entry_parsers.parsers = {}
+    if settings not in parsers:
+        parsers[settings] = get_parser(*settings)
+    try:
+        database = parse_text(parsers[settings], bibtex)
+    except UnicodeDecodeError:
+        return None
+
+    # we expect a database with a single entry
+    if len(database.entries) == 1:
+        return database.entries[0]
+    return None
+
+
+def decode(content):
+    """
+    Decode content of a .bib file and translate line endings, just like
+    reading the file in text mode would.
+
+    Parameters
+    ----------
+    content: bytes
+
+    Returns
+    -------
+    str
+    """
+    return content.decode().replace("\r\n", "\n").replace("\r", "\n")
+
+
+def get_source_hashes(content, entries):
+    """
+    Hash the source of parsed entries, see scanner.hash_block. Entries are
+    matched to blocks by key, in order.
+
+    Parameters
+    ----------
+    content: bytes
+        Content the entries were parsed from
+    entries: list of dict
+        Parsed entries
+
+    Returns
+    -------
+    hashes: list of bytes or None
+        Hashes of all entries. None if no matching block was found.
+    """
+    # Offsets of blocks by key
+    blocks = {}
+    for start, end, blocktype, key in scan_blocks(content):
+        if blocktype not in NON_ENTRY_TYPES:
+            blocks.setdefault(key, []).append((start, end))
+
+    hashes = []
+    previous = 0
+    for entry in entries:
+        candidates = blocks.get(entry["ID"], [])
+        # Skip blocks before the previous match
+        while candidates and candidates[0][0] < previous:
+            candidates.pop(0)
+        if candidates:
+            start, end = candidates.pop(0)
+            hashes.append(hash_block(content[start:end]))
+            previous = end
+        else:
+            hashes.append(None)
+    return hashes
+
+
+def read_file(name, settings, sort_fields):
+    """
+    Read a .bib file and split it into chunks. If neither the file nor the
+    parser settings changed since the file was last parsed, the parsed chunks
+    are read from the cache instead.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    settings: (bool, bool)
+        Parser settings, see get_parser
+    sort_fields: tuple of str
+        Fields to generate sort keys for. Sort keys of other fields are
+        generated on demand by the items.
+
+    Returns
+    -------
+    status: list of str
+        Empty list on success, error codes otherwise
+    key: tuple
+        Cache key of the file
+    payloads: list of bytes or None
+        Cached chunks, see parse_chunk. None if file is not cached.
+    chunks: list of Chunk
+        Chunks that need to be parsed
+    """
+    try:
+        with open(name, "rb") as bibtex_file:
+            stat = fstat(bibtex_file.fileno())
+            content = bibtex_file.read()
+    except OSError:
+        return ["error", "file_error"], None, None, []
+
+    # Warm start: deserialize instead of parsing
+    key = cache.get_cache_key(name, stat, content, *settings)
+    payloads = cache.load(name, key)
+    if payloads is not None:
+        return [], key, payloads, []
+
+    # Only split the file if every '@' at the start of a line starts a block,
+    # otherwise the parser reads the whole file at once
+    if len(find_top_level_blocks(content)) == len(find_blocks(content)):
+        ranges = split_chunks(content, CHUNK_SIZE, FIRST_CHUNK_SIZE)
+    else:
+        ranges = [(0, len(content))]
+
+    # Strings are only needed if they can be defined in another chunk
+    strings = {}
+    if len(ranges) > 1:
+        parser = get_parser(*settings)
+        try:
+            strings = parser.parse(decode(find_string_blocks(content))).strings
+        except UnicodeDecodeError:
+            return ["error", "parse_error"], None, None, []
+
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    chunks = [Chunk(name, stamp, start, end, strings, settings, sort_fields)
+              for start, end in ranges]
+
+    return [], key, None, chunks
+
+
+def parse_chunk(chunk):
+    """
+    Parse a chunk of a .bib file and generate the sort keys of its entries.
+
+    Parameters
+    ----------
+    chunk: Chunk
+
+    Returns
+    -------
+    status: list of str
+        Empty list on success, error codes otherwise
+    payload: bytes or None
+        Pickled tuple of the parsed database, a list with the sort keys and
+        a list with the source hashes of all its entries. The payload is
+        passed on to the cache as is.
+    """
+    try:
+        with open(chunk.name, "rb") as bibtex_file:
+            stat = fstat(bibtex_file.fileno())
+            # File changed after it was split into chunks
+            if (stat.st_size, stat.st_mtime_ns) != chunk.stamp:
+                return ["error", "file_error"], None
+            bibtex_file.seek(chunk.start)
+            content = bibtex_file.read(chunk.end - chunk.start)
+    except OSError:
+        return ["error", "file_error"], None
+
+    parser = get_parser(*chunk.settings)
+    try:
+        database = parser.parse(decode(content))
+    except UnicodeDecodeError:
+        return ["error", "parse_error"], None
+
+    # Add strings defined in other chunks and let them refer to the string
+    # definitions of this chunk
+    for name, value in chunk.strings.items():
+        database.strings.setdefault(name, value)
+    for value in database.strings.values():
+        rebind_strings(value, database)
+
+    sort_values = [get_sort_values(entry, chunk.sort_fields) for entry in database.entries]
+    hashes = get_source_hashes(content, database.entries)
+    payload = pickle.dumps((database, sort_values, hashes), pickle.HIGHEST_PROTOCOL)
+
+    return [], payload
+
+
+def scan_file(name, settings):
+    """
+    Scan a .bib file for the byte ranges of its blocks. Strings, comments and
+    preambles are parsed, entries are only recorded with their type and key.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    settings: (bool, bool)
+        Parser settings, see get_parser
+
+    Returns
+    -------
+    status: list of str
+        Empty list on success, error codes otherwise. Contains 'unscannable'
+        if not every '@' at the start of a line belongs to a scanned block,
+        for example because of unbalanced braces. Such files have to be read
+        with the parser, see read_file.
+    stamp: (int, int)
+        Size and modification time of the file when it was scanned
+    database: BibDatabase or None
+        Database with parsed strings, comments and preambles. Entries only
+        contain the fields 'ID' and 'ENTRYTYPE'.
+    sort_values: list of dict
+        Sort keys of the entries by 'ID'
+    spans: list of (int, int)
+        Byte ranges of the entries
+    """
+    try:
+        with open(name, "rb") as bibtex_file:
+            stat = fstat(bibtex_file.fileno())
+            with mmap(bibtex_file.fileno(), 0, access=ACCESS_READ) as content:
+                blocks = scan_blocks(content)
+                if len(blocks) != len(find_blocks(content)):
+                    return ["unscannable"], None, None, [], []
+                other = b"\n".join(content[start:end] for start, end, blocktype, _key in blocks
+                                   if blocktype in NON_ENTRY_TYPES)
+    except (OSError, ValueError):
+        return ["error", "file_error"], None, None, [], []
+    except UnicodeDecodeError:
+        return ["error", "parse_error"], None, None, [], []
+
+    parser = get_parser(*settings)
+    try:
+        database = parser.parse(decode(other))
+    except UnicodeDecodeError:
+        return ["error", "parse_error"], None, None, [], []
+
+    spans = []
+    for start, end, blocktype, key in blocks:
+        if blocktype not in NON_ENTRY_TYPES:
+            database.entries.append({"ENTRYTYPE": blocktype, "ID": key})
+            spans.append((start, end))
+    sort_values = [get_sort_values(entry, ("ID",)) for entry in database.entries]
+
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    return [], stamp, database, sort_values, spans
+
+
+def rescan_file(name, settings, known):
+    """
+    Read a .bib file that changed on disk. Only entries whose source changed
+    are parsed.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    settings: (bool, bool)
+        Parser settings, see get_parser
+    known: dict
+        Number of unmodified entries in memory by source hash
+
+    Returns
+    -------
+    status: list of str
+        Empty list on success, error codes otherwise. Contains 'unscannable'
+        if not every '@' at the start of a line belongs to a scanned block,
+        then the file has to be read again, see read_file.
+    database: BibDatabase or None
+        Database with parsed strings, comments and preambles, but no entries
+    blocks: list of (bytes, dict or None)
+        Source hash and parsed entry of all entries in the file. The entry is
+        None if its source is known.
+    """
+    try:
+        with open(name, "rb") as bibtex_file:
+            content = bibtex_file.read()
+        blocks = scan_blocks(content)
+    except OSError:
+        return ["error", "file_error"], None, []
+    except UnicodeDecodeError:
+        return ["error", "parse_error"], None, []
+    if len(blocks) != len(find_blocks(content)):
+        return ["unscannable"], None, []
+
+    parser = get_parser(*settings)
+    other = b"\n".join(content[start:end] for start, end, blocktype, _key in blocks
+                       if blocktype in NON_ENTRY_TYPES)
+    try:
+        database = parse_text(parser, decode(other))
+    except UnicodeDecodeError:
+        return ["error", "parse_error"], None, []
+
+    known = dict(known)
+    entries = []
+    for start, end, blocktype, _key in blocks:
+        if blocktype in NON_ENTRY_TYPES:
+            continue
+        source_hash = hash_block(content[start:end])
+        if known.get(source_hash, 0) > 0:
+            known[source_hash] -= 1
+            entries.append((source_hash, None))
+            continue
+        try:
+            changed = parse_text(parser, decode(content[start:end]))
+        except UnicodeDecodeError:
+            return ["error", "parse_error"], None, []
+        # Skip blocks that are not valid entries, just like the parser does
+        if len(changed.entries) == 1:
+            entries.append((source_hash, changed.entries[0]))
+
+    return [], database, entries
+
+
+def read_strings(name, settings):
+    """
+    Read the string definitions of a .bib file. All other blocks are skipped
+    without parsing them. Strings are cached by path, size and modification
+    time of the file.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    settings: (bool, bool)
+        Parser settings, see get_parser
+
+    Returns
+    -------
+    status: list of str
+        Empty list on success, error codes otherwise
+    strings: dict or None
+        String definitions by name
+    """
+    try:
+        with open(name, "rb") as bibtex_file:
+            key = cache.get_strings_cache_key(name, fstat(bibtex_file.fileno()), *settings)
+            strings = cache.load(name, key, "strings")
+            if strings is not None:
+                return [], strings
+            content = bibtex_file.read()
+    except OSError:
+        return ["error", "file_error"], None
+
+    parser = get_parser(*settings)
+    try:
+        strings = parser.parse(decode(find_string_blocks(content))).strings
+    except UnicodeDecodeError:
+        return ["error", "parse_error"], None
+
+    cache.save(name, key, strings, "strings")
+    return [], strings
+
+
+def save_chunks(name, key, payloads):
+    """
+    Write parsed chunks of a .bib file to the cache.
+
+    Parameters
+    ----------
+    name: str
+        Full path of the .bib file
+    key: tuple
+        Cache key, as returned by read_file
+    payloads: list of bytes
+        Parsed chunks, as returned by parse_chunk
+    """
+    cache.save(name, key, payloads)
+
+
+def read_payload(payload):
+    """
+    Unpickle a parsed chunk.
+
+    Parameters
+    ----------
+    payload: bytes
+        Parsed chunk, as returned by parse_chunk
+
+    Returns
+    -------
+    database: BibDatabase
+    sort_values: list of dict
+    hashes: list of bytes or None
+    """
+    return pickle.loads(payload)
@@ -14,7 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from gi.repository import Gtk, Gdk, GLib, Gio
+from gi.repository import Gtk, Gdk, GLib
 from os.path import split
 from time import sleep
 
@@ -35,6 +35,8 @@ from .itemlist import ItemlistPage
 from .itemlist import ItemlistTabView
 from .itemlist import ItemlistToolbar
 from .layout_manager import string_to_layout
+from .loader import read_payload
+from .memory import release_memory
 from .menus import FilterPopover
 from .menus import SortPopover
 from .watcher import Watcher
@@ -42,6 +44,15 @@ from .watcher import Watcher
 
 DEFAULT_EDITOR = get_default_entrytype()
 
+# Delay in ms after the last keystroke before the source view is parsed
+PARSE_DELAY = 150
+
+# Interval in ms to check if a file that is saved on close finished loading
+LOADING_POLL = 100
+
+# Number of items whose fields are cached at once after loading a file
+PREWARM_BATCH = 200
+
 
 class MainWidget(Gtk.Paned):
     def __init__(self, store):
@@ -51,6 +62,9 @@ class MainWidget(Gtk.Paned):
         self.editors = {}
         self.watchers = {}
         self.copy_paste_buffer = None
+        self.parse_timeout = None       # Pending parse of source view
+        self.parse_future = None        # Running parse of source view
+        self.parse_version = 0          # Incremented on every edit of source view
 
         self.assemble_left_pane()
         self.assemble_right_pane()
@@ -132,8 +146,7 @@ class MainWidget(Gtk.Paned):
 
         item = self.get_current_item()
         if item:
-            item.bibfile.itemlist.unselect_row(item.row)
-            item.bibfile.itemlist.select_row(item.row)
+            self.on_selected_rows_changed(item.bibfile.itemlist)
         else:
             self.show_editor(DEFAULT_EDITOR)
 
@@ -151,7 +164,7 @@ class MainWidget(Gtk.Paned):
 
     def new_itemlist(self, bibfile, state=None, change_buffer=None):
         itemlist = Itemlist(bibfile, state, change_buffer)
-        itemlist.connect("selected-rows-changed", self.on_selected_rows_changed)
+        itemlist.selection.connect("selection-changed", self.on_selection_changed, itemlist)
         itemlist.event_controller.connect("key-pressed", self.on_itemlist_key_pressed)
         itemlist.drop_target.connect("drop", self.on_drop)
 
@@ -197,10 +210,12 @@ class MainWidget(Gtk.Paned):
         return []
 
     def get_current_item(self, itemlist=None):
-        items = self.get_selected_items(itemlist)
-        if len(items) != 1:
+        if itemlist is None:
+            itemlist = self.get_current_itemlist()
+        # Avoid collecting all items of large selections
+        if not itemlist or itemlist.count_selected() != 1:
             return None
-        return items[0]
+        return itemlist.get_selected_items()[0]
 
     def add_items(self, _button=None, entries=None):
         itemlist = self.get_current_itemlist()
@@ -209,7 +224,7 @@ class MainWidget(Gtk.Paned):
 
         if itemlist:
             items = [itemlist.bibfile.append_item(entry) for entry in entries]
-            itemlist.add_rows(items)
+            itemlist.add_items(items)
             change = Change.Show(items)
             itemlist.change_buffer.push_change(change)
 
@@ -223,14 +238,23 @@ class MainWidget(Gtk.Paned):
         items = self.get_selected_items()
         self.delete_items(items)
 
+    def show_item(self, item):
+        # Switch to tab of item and select it
+        itemlist = item.bibfile.itemlist
+        self.tabbox.tabview.set_selected_page(itemlist.page.tabview_page)
+        itemlist.reveal_item(item)
+        itemlist.select_item(item, True)
+        itemlist.focus_on_selected_items(0)
+
     def focus_on_current_item(self, _button=None):
         itemlist = self.get_current_itemlist()
         if itemlist:
             itemlist.focus_on_selected_items()
 
+    def on_selection_changed(self, _selection, _position, _n_items, itemlist):
+        self.on_selected_rows_changed(itemlist)
+
     def on_selected_rows_changed(self, itemlist):
-        # work around listbox scrolling horizontally on row changes
-        itemlist.get_parent().get_parent().get_hadjustment().set_value(0)
         item = self.get_current_item(itemlist)
         if item and item.bibfile:
             entrytype = item.entry["ENTRYTYPE"]
@@ -288,24 +312,64 @@ class MainWidget(Gtk.Paned):
     # Source view
 
     def on_source_view_modified(self, _buffer):
+        # Supersede pending and running parses
+        self.parse_version += 1
+        if self.parse_timeout:
+            GLib.source_remove(self.parse_timeout)
+            self.parse_timeout = None
+        if self.parse_future:
+            self.parse_future.cancel()
+            self.parse_future = None
+
         if get_parse_on_fly():
-            self.update_bibtex()
+            # Parse in worker process once the user stops typing
+            self.parse_timeout = GLib.timeout_add(PARSE_DELAY, self.update_bibtex_async)
         else:
             self.source_view.set_status("modified")
 
+    def update_bibtex_async(self):
+        self.parse_timeout = None
+        bibtex = self.source_view.form.get_text()
+        item = self.get_current_item()
+        if bibtex and item:
+            version = self.parse_version
+            self.parse_future = self.store.parse_entry(bibtex)
+            self.parse_future.add_done_callback(
+                lambda future: GLib.idle_add(self.update_bibtex_finalize, future, item, version))
+        return GLib.SOURCE_REMOVE
+
+    def update_bibtex_finalize(self, future, item, version):
+        # Drop results of superseded edits, or if another item was selected
+        if version != self.parse_version or future.cancelled():
+            return
+        self.parse_future = None
+        if item is not self.get_current_item() or item.bibfile is None:
+            return
+
+        try:
+            new_entry = future.result()
+        except Exception:
+            # Worker process died
+            new_entry = None
+        if new_entry:
+            new_entry = item.bibfile.bind_entry(new_entry)
+        self.apply_entry(item, new_entry)
+
     def update_bibtex(self, _button=None):
         bibtex = self.source_view.form.get_text()
         if bibtex:
             item = self.get_current_item()
-            new_entry = item.bibfile.parse_entry(bibtex)
-            old_entry = item.entry
-            if new_entry:
-                self.source_view.set_status("valid")
-                if not entries_equal(old_entry, new_entry):
-                    change = Change.Replace(item, old_entry, new_entry)
-                    item.bibfile.itemlist.change_buffer.push_change(change)
-            else:
-                self.source_view.set_status("invalid")
+            self.apply_entry(item, item.bibfile.parse_entry(bibtex))
+
+    def apply_entry(self, item, new_entry):
+        old_entry = item.entry
+        if new_entry:
+            self.source_view.set_status("valid")
+            if not entries_equal(old_entry, new_entry):
+                change = Change.Replace(item, old_entry, new_entry)
+                item.bibfile.itemlist.change_buffer.push_change(change)
+        else:
+            self.source_view.set_status("invalid")
 
     # File watcher
 
@@ -371,38 +435,235 @@ class MainWidget(Gtk.Paned):
         page.tabview_page.set_title(split(name)[1])
         page.tabview_page.set_tooltip(name)
 
-        def parse_file(task, _obj, _data, _cancellable):
-            status = self.store.add_file(name)
-            task.return_value(status)
-
-        def on_file_parsed(_obj, task):
-            success, status = task.propagate_value()
-            if not success:
-                status = ["error"]
+        cache_key = None    # Key to cache the parsed file
+        cached = False      # File was read from the cache
+        n_chunks = 0        # Number of chunks the file was split into
+        payloads = []       # Chunks added to the file, in order
+        parsed = {}         # Chunks that were parsed out of order
+        futures = []        # Chunks submitted to the executor
+        aborted = False     # Loading failed or tab was closed
+
+        def abort(status=None):
+            nonlocal aborted
+            aborted = True
+            for future in futures:
+                future.cancel()
+
+            # Discard partially read file
+            if page.itemlist:
+                page.remove_itemlist()
+                self.store.remove_file(name)
 
             page.tabview_page.set_loading(False)
-
-            if "error" in status:
+            if status:
                 page.show_error_screen(status)
                 remove_from_recent(name)
                 self.get_root().update_recent_file_menu()
-            elif "file_open" in status:
-                self.tabbox.tabview.close_page(page.tabview_page)
+
+        def on_file_read(future):
+            nonlocal cache_key, cached, n_chunks
+            try:
+                status, cache_key, cached_payloads, chunks = future.result()
+            except Exception:
+                # Worker process died
+                status, cached_payloads, chunks = ["error"], None, []
+
+            if "error" in status:
+                abort(status)
+            elif cached_payloads is not None:
+                # Add cached chunks in the main loop, one at a time
+                cached = True
+                n_chunks = len(cached_payloads)
+                for n, payload in enumerate(cached_payloads):
+                    GLib.idle_add(add_chunk, n, [], payload)
             else:
-                bibfile = self.store.bibfiles[name]
-                itemlist = self.new_itemlist(bibfile, state)
-                page.add_itemlist(itemlist)
-                GLib.idle_add(self.add_watcher, name)
-                if "empty" in status:
-                    page.empty_bar.reveal()
+                # Parse chunks in parallel
+                n_chunks = len(chunks)
+                for n, chunk in enumerate(chunks):
+                    future = self.store.parse_chunk(chunk)
+                    future.add_done_callback(lambda future, n=n: GLib.idle_add(on_chunk_parsed, future, n))
+                    futures.append(future)
+
+        def on_chunk_parsed(future, n):
+            try:
+                status, payload = future.result()
+            except Exception:
+                # Worker process died or parser raised
+                status, payload = ["error"], None
+            add_chunk(n, status, payload)
+
+        def add_chunk(n, status, payload):
+            # Tab was closed while loading
+            if not aborted and page.get_parent() is None:
+                abort()
+            if aborted:
+                return
+            if "error" in status:
+                abort(status)
+                return
+
+            # Add chunks in order, keep those that arrived early
+            parsed[n] = payload
+            while len(payloads) in parsed:
+                payload = parsed.pop(len(payloads))
+                payloads.append(payload)
+                database, sort_values, hashes = read_payload(payload)
+
+                # First chunk: create bibfile and show itemlist
+                if len(payloads) == 1:
+                    status = self.store.add_file(name, database, sort_values, hashes)
+                    if "file_open" in status:
+                        abort()
+                        self.tabbox.tabview.close_page(page.tabview_page)
+                        return
+                    bibfile = self.store.bibfiles[name]
+                    bibfile.loading = n_chunks > 1
+                    itemlist = self.new_itemlist(bibfile, state)
+                    page.add_itemlist(itemlist)
+                # Other chunks: append to bibfile and itemlist
+                else:
+                    items = self.store.extend_file(name, database, sort_values, hashes)
+                    page.itemlist.add_items(items)
+
+            if len(payloads) == n_chunks:
+                finish()
+
+        def on_file_scanned(future):
+            try:
+                status, stamp, database, sort_values, spans = future.result()
+            except Exception:
+                # Worker process died
+                status = ["error"]
 
-        # open file in thread
-        task = Gio.Task.new(None, None, on_file_parsed)
-        task.run_in_thread(parse_file)
+            # Tab was closed while loading
+            if page.get_parent() is None:
+                abort()
+                return
+            if "error" in status:
+                abort(status)
+                return
+            # Scanner lost track of the blocks, parse the whole file instead
+            if "unscannable" in status:
+                read_file()
+                return
+
+            status = self.store.add_file(name, database, sort_values, stamp=stamp, spans=spans)
+            if "file_open" in status:
+                abort()
+                self.tabbox.tabview.close_page(page.tabview_page)
+                return
+            if "error" in status:
+                abort(status)
+                return
+            itemlist = self.new_itemlist(self.store.bibfiles[name], state)
+            page.add_itemlist(itemlist)
+            finish()
+
+        def finish():
+            page.tabview_page.set_loading(False)
+            page.loading_bar.conceal()
+            status = self.store.finish_file(name)
+            GLib.idle_add(self.add_watcher, name)
+            self.prewarm_file(self.store.bibfiles[name])
+            if "empty" in status:
+                page.empty_bar.reveal()
+            if cache_key is not None and not cached:
+                self.store.save_chunks(name, cache_key, payloads)
+
+        def read_file():
+            # read and parse file in worker processes, add chunks in main loop
+            # only generate sort keys that are needed to show the itemlist
+            sort_fields = ("ID", *Itemlist.sort_fields_from_string(state))
+            future = self.store.read_file(name, sort_fields)
+            future.add_done_callback(lambda future: GLib.idle_add(on_file_read, future))
+
+        if self.store.is_large_file(name):
+            # scan file in worker process, parse entries on demand
+            future = self.store.scan_file(name)
+            future.add_done_callback(lambda future: GLib.idle_add(on_file_scanned, future))
+        else:
+            read_file()
 
         return page
 
+    def prewarm_file(self, bibfile):
+        # Cache pretty fields of parsed items in idle time, a batch at a time,
+        # then build the search index, so that the first search is fast.
+        # Entries of scanned files are only parsed on demand.
+        if bibfile.source is not None:
+            return
+        items = list(bibfile.items)
+
+        def prewarm_batch(start):
+            # File was closed in the meantime
+            if bibfile.itemlist is None:
+                return GLib.SOURCE_REMOVE
+            for item in items[start:start + PREWARM_BATCH]:
+                if item.bibfile is not None:
+                    item.prewarm()
+            if start + PREWARM_BATCH < len(items):
+                GLib.idle_add(prewarm_batch, start + PREWARM_BATCH, priority=GLib.PRIORITY_LOW)
+            else:
+                self.store.build_index(bibfile)
+            return GLib.SOURCE_REMOVE
+
+        GLib.idle_add(prewarm_batch, 0, priority=GLib.PRIORITY_LOW)
+
     def reload_file(self, bibfile):
+        # Scanned or partially read files are reopened
+        if bibfile.source is not None or bibfile.loading:
+            self.reopen_file(bibfile)
+            return
+
+        # Only parse entries that changed on disk, patch itemlist in place
+        bibfile.loading = True
+        bibfile.itemlist.page.tabview_page.set_loading(True)
+        future = self.store.rescan_file(bibfile.name)
+        future.add_done_callback(lambda future: GLib.idle_add(self.reload_file_finalize,
+                                                              bibfile, future))
+
+    def reload_file_finalize(self, bibfile, future):
+        # File was closed while reading
+        if bibfile.itemlist is None:
+            return
+
+        bibfile.loading = False
+        bibfile.itemlist.page.tabview_page.set_loading(False)
+        try:
+            status, database, entries = future.result()
+        except Exception:
+            # Worker process died
+            status = ["error"]
+        # Entries the scanner missed would be removed, read the whole file
+        if "error" in status or "unscannable" in status:
+            self.reopen_file(bibfile)
+            return
+
+        itemlist = bibfile.itemlist
+        adj = itemlist.get_vadjustment().get_value()
+        items = itemlist.get_selected_items()
+        strings = bibfile.strings_to_text()
+
+        result = self.store.reload_file(bibfile.name, database, entries)
+        if result is None:
+            self.reopen_file(bibfile)
+            return
+        changed, added, _removed = result
+
+        if bibfile.strings_to_text() != strings:
+            itemlist.refresh()
+        else:
+            for item in changed:
+                itemlist.update_item(item)
+        itemlist.add_items(added)
+        itemlist.invalidate_filter()
+        itemlist.reselect_items(items, adj)
+
+        bibfile.created = False
+        bibfile.set_unsaved(False)
+        GLib.idle_add(self.add_watcher, bibfile.name)
+
+    def reopen_file(self, bibfile):
         name = bibfile.name
         state = bibfile.itemlist.state_to_string()
         tabview_page = bibfile.itemlist.page.tabview_page
@@ -525,12 +786,16 @@ class MainWidget(Gtk.Paned):
             page.remove_itemlist()
             self.tabbox.tabview.close_page(page.tabview_page)
 
-            # Clean up
+            # Clean up, not needed if the app is closed anyway
             self.remove_watcher(bibfile.name)
-            self.store.remove_file(bibfile.name)
+            if not close_app:
+                self.store.remove_file(bibfile.name)
 
         if close_app:
+            self.store.shutdown()
             self.get_root().destroy()
+        else:
+            release_memory(f"closing {len(bibfiles)} file(s)")
 
     def save_file(self, bibfile=None, close_data=None):
         if bibfile is None:
@@ -540,6 +805,22 @@ class MainWidget(Gtk.Paned):
             else:
                 return None
 
+        # File was closed in the meantime. If loading failed while the file
+        # was waiting to be saved on close, continue with the other files.
+        if bibfile.itemlist is None:
+            if close_data is not None:
+                self.skip_closed_file(bibfile, close_data)
+            return None
+
+        # Do not write partially read files. If the file is saved on close,
+        # save it once it is read completely and continue closing files.
+        if bibfile.loading:
+            if close_data is not None:
+                GLib.timeout_add(LOADING_POLL, self.save_file, bibfile, close_data)
+            else:
+                bibfile.itemlist.page.loading_bar.reveal()
+            return None
+
         if bibfile.unsaved:
             if bibfile.created:
                 self.save_file_as(close_data=close_data)
@@ -547,6 +828,14 @@ class MainWidget(Gtk.Paned):
                 self.save_file_as(bibfile, bibfile.name, close_data)
         return None
 
+    def skip_closed_file(self, bibfile, close_data):
+        bibfiles, n, force, close_app = close_data
+        bibfiles = [other for other in bibfiles if other is not bibfile]
+        if n < len(bibfiles):
+            self.close_files_dialog(None, "close", bibfiles, n, force, close_app)
+        else:
+            self.close_files_finalize(None, "close", bibfiles, n, force, close_app)
+
     def save_all_files(self):
         for bibfile in self.store.bibfiles.values():
             self.save_file(bibfile)
@@ -562,6 +851,11 @@ class MainWidget(Gtk.Paned):
                 bibfile = itemlist.bibfile
             else:
                 return None
+
+        # Do not write or rename partially read files, see save_file
+        if bibfile.loading:
+            bibfile.itemlist.page.loading_bar.reveal()
+            return None
         self.confirm_save_dialog(bibfile, new_name, close_data)
         return None
 
@@ -0,0 +1,74 @@
+# memory.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from gi.repository import GLib
+
+from os import sysconf
+
+from gc import collect
+
+from ctypes import CDLL
+
+
+# Log domain of debug messages. GLib shows them if G_MESSAGES_DEBUG is set,
+# like G_MESSAGES_DEBUG=badabib or G_MESSAGES_DEBUG=all
+LOG_DOMAIN = "badabib"
+
+
+def get_rss():
+    """
+    Get the resident memory of this process.
+
+    Returns
+    -------
+    rss: int or None
+        Resident memory in bytes, None if it is unknown
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def trim_heap():
+    """Return free memory of the heap to the system, only supported by glibc."""
+    try:
+        CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def release_memory(reason):
+    """
+    Free objects in reference cycles and return free memory to the system,
+    for example, after closing files. The released memory is reported as a
+    debug message.
+
+    Parameters
+    ----------
+    reason: str
+        Description of what was freed, used in the report
+    """
+    before = get_rss()
+    collect()
+    trim_heap()
+    after = get_rss()
+    if before is not None and after is not None:
+        released = (before - after) / 2**20
+        message = GLib.Variant("s", f"{reason} released {released:.1f} MiB")
+        GLib.log_variant(LOG_DOMAIN, GLib.LogLevelFlags.LEVEL_DEBUG,
+                         GLib.Variant("a{sv}", {"MESSAGE": message}))
@@ -22,6 +22,8 @@ from .config_manager import entrytype_dict
 from .config_manager import field_dict
 from .config_manager import sort_fields
 
+N_THEN_KEYS = 2
+
 
 def create_menu_item(label, action, target=None):
     item = Gio.MenuItem()
@@ -96,6 +98,7 @@ class MainMenu(Gtk.PopoverMenu):
     def __init__(self):
         super().__init__()
 
+        find_all = create_menu_item("Search All Files", "find_all")
         manage_strings = create_menu_item("Manage Strings", "manage_strings")
         custom_editor = create_menu_item("Customize Editor", "custom_editor")
         preferences = create_menu_item("Preferences", "show_prefs")
@@ -105,6 +108,7 @@ class MainMenu(Gtk.PopoverMenu):
 
         save_section = Gio.Menu()
         save_section.append_item(save_all)
+        save_section.append_item(find_all)
 
         settings_section = Gio.Menu()
         settings_section.append_item(manage_strings)
@@ -134,7 +138,14 @@ class FilterPopover(Gtk.Popover):
         self.switches = []
         self.track_changes = True
         self.itemlist = itemlist
+        self.visible_label = Gtk.Label()
+        self.visible_label.add_css_class("dim-label")
         self.assemble()
+        self.update_visible_label()
+
+        # Update number of visible entries while filter is changed
+        self.handler = itemlist.filter_model.connect("items-changed", self.update_visible_label)
+        self.connect("closed", self.on_closed)
         self.popup()
 
     def assemble(self):
@@ -144,7 +155,7 @@ class FilterPopover(Gtk.Popover):
 
         all_active = True
         all_count = self.itemlist.bibfile.count_all()
-        n = 1
+        n = 2
         count = []
 
         for entrytype in entrytype_dict:
@@ -191,8 +202,9 @@ class FilterPopover(Gtk.Popover):
             label_text = "All (" + str(all_count) + ")"
             label = Gtk.Label(label=label_text)
 
-            switch_grid.attach(label, 0, 0, 1, 1)
-            switch_grid.attach(switch, 1, 0, 1, 1)
+            switch_grid.attach(label, 0, 1, 1, 1)
+            switch_grid.attach(switch, 1, 1, 1, 1)
+            switch_grid.attach(self.visible_label, 0, 0, 2, 1)
         else:
             label = Gtk.Label(label="Empty File")
             label.set_sensitive(False)
@@ -200,6 +212,14 @@ class FilterPopover(Gtk.Popover):
 
         self.set_child(switch_grid)
 
+    def update_visible_label(self, *_args):
+        n_visible = self.itemlist.count_visible()
+        n_all = self.itemlist.bibfile.count_all()
+        self.visible_label.set_text(f"Showing {n_visible} of {n_all}")
+
+    def on_closed(self, _popover):
+        self.itemlist.filter_model.disconnect(self.handler)
+
     def on_switch_clicked(self, switch, state, entrytype):
         if self.track_changes:
             if switch == self.switches[-1]:
@@ -215,7 +235,7 @@ class FilterPopover(Gtk.Popover):
                 self.track_changes = True
 
             self.itemlist.invalidate_filter()
-            self.itemlist.reselect_rows()
+            self.itemlist.reselect_items()
 
 
 class SortPopover(Gtk.Popover):
@@ -224,6 +244,8 @@ class SortPopover(Gtk.Popover):
         self.set_parent(sort_button)
         self.set_position(Gtk.PositionType.TOP)
         self.itemlist = itemlist
+        self.then_rows = []
+        self.updating = False
         self.assemble()
         self.popup()
 
@@ -259,16 +281,68 @@ class SortPopover(Gtk.Popover):
         sort_key_buttons[self.itemlist.sort_key].set_active(True)
         reverse_buttons[self.itemlist.sort_reverse].set_active(True)
 
+        vbox.append(Gtk.Separator())
+
+        then_label = Gtk.Label(label="Then by", xalign=0)
+        then_label.add_css_class("dim-label")
+        vbox.append(then_label)
+
+        # Further sort keys, each with a field and a direction
+        labels = ["None"] + [field_dict[field] for field in sort_fields]
+        for _ in range(N_THEN_KEYS):
+            dropdown = Gtk.DropDown.new_from_strings(labels)
+            dropdown.set_hexpand(True)
+            reverse_button = Gtk.ToggleButton()
+            reverse_button.set_icon_name("view-sort-descending-symbolic")
+            reverse_button.set_tooltip_text("Descending")
+            hbox = Gtk.Box(spacing=6)
+            hbox.append(dropdown)
+            hbox.append(reverse_button)
+            vbox.append(hbox)
+            self.then_rows.append((dropdown, reverse_button))
+
+        self.update_then_rows()
+        for dropdown, reverse_button in self.then_rows:
+            dropdown.connect("notify::selected", self.on_then_changed)
+            reverse_button.connect("toggled", self.on_then_changed)
+
         self.set_child(vbox)
 
+    def update_then_rows(self):
+        self.updating = True
+        sort_keys = self.itemlist.sort_keys[1:]
+        for n, (dropdown, reverse_button) in enumerate(self.then_rows):
+            if n < len(sort_keys):
+                field, reverse = sort_keys[n]
+                dropdown.set_selected(sort_fields.index(field) + 1)
+                reverse_button.set_active(reverse)
+            else:
+                dropdown.set_selected(0)
+                reverse_button.set_active(False)
+        self.updating = False
+
     def on_entrytype_clicked(self, radio_button, field):
         is_active = radio_button.get_active()
         if is_active and field != self.itemlist.sort_key:
-            self.itemlist.sort_key = field
-            self.itemlist.invalidate_sort()
+            self.itemlist.set_sort_key(field)
+            # Field is no longer available as further sort key
+            self.update_then_rows()
 
     def on_order_clicked(self, radio_button, reverse):
         is_active = radio_button.get_active()
         if is_active and self.itemlist.sort_reverse != reverse:
-            self.itemlist.sort_reverse = reverse
-            self.itemlist.invalidate_sort()
+            self.itemlist.set_sort_reverse(reverse)
+
+    def on_then_changed(self, *_args):
+        if self.updating:
+            return
+
+        sort_keys = [self.itemlist.sort_keys[0]]
+        for dropdown, reverse_button in self.then_rows:
+            selected = dropdown.get_selected()
+            if selected > 0:
+                sort_keys.append((sort_fields[selected - 1], reverse_button.get_active()))
+        self.itemlist.set_sort_keys(sort_keys)
+
+        # Fields that are already used are dropped, show the keys in use
+        self.update_then_rows()
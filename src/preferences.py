@@ -140,9 +140,11 @@ class PreferencesWindow(Adw.PreferencesWindow):
     def update_writer(self):
         for file in self.main_window.store.bibfiles.values():
             file.writer = file.store.get_default_writer()
+            # Cheap, sources are regenerated on demand
+            for item in file.items:
+                item.update_bibtex()
         item = self.main_window.main_widget.get_current_item()
         if item:
-            item.update_bibtex()
             self.main_window.main_widget.source_view.update(item)
 
     @staticmethod
@@ -0,0 +1,263 @@
+# scanner.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# The scanner works on the raw bytes of a .bib file. All characters it looks
+# for are ASCII, which never occur inside multi-byte UTF-8 sequences, so byte
+# offsets can be used to slice the file without decoding it first. Content
+# can be given as bytes or as a memory-mapped file.
+
+
+import re
+
+from hashlib import blake2b
+
+
+# '@' at the start of a line, optionally indented, starts a new block
+BLOCK_START = re.compile(rb"^[ \t]*@", re.MULTILINE)
+
+# Type and key of a block, for example '@article{key,'
+BLOCK_HEAD = re.compile(rb"@\s*([^\s{(]*)\s*[{(]\s*([^,\s})]*)")
+
+# Type of a block followed by an opening brace, where scanning picks up again
+# after a brace that is never closed
+BLOCK_TYPE = re.compile(rb"@[ \t]*[A-Za-z]+[ \t]*[{(]")
+
+# Line starting with '%', braces in it are not counted
+COMMENT_LINE = re.compile(rb"^[ \t]*%.*$", re.MULTILINE)
+
+# Block types that are not entries
+NON_ENTRY_TYPES = ("string", "comment", "preamble")
+
+
+def find_blocks(content):
+    """
+    Find offsets of all candidate blocks (entries, strings, comments, ...).
+    Candidates inside braces, for example an '@' at the start of a line in
+    an abstract, are not filtered out here, see split_chunks.
+
+    Parameters
+    ----------
+    content: bytes
+        Content of a .bib file
+
+    Returns
+    -------
+    list of int
+        Offsets of the '@' characters
+    """
+    return [match.end() - 1 for match in BLOCK_START.finditer(content)]
+
+
+def count_braces(segment):
+    """
+    Count opening minus closing braces, ignoring lines starting with '%'.
+
+    Parameters
+    ----------
+    segment: bytes
+
+    Returns
+    -------
+    int
+    """
+    if b"%" in segment:
+        segment = COMMENT_LINE.sub(b"", segment)
+    return segment.count(b"{") - segment.count(b"}")
+
+
+def find_top_level_blocks(content):
+    """
+    Find offsets of all blocks that are not enclosed in braces. Braces in
+    comment lines starting with '%' and in @comment blocks are not counted.
+    If a block closes more braces than it opens, the next block starts at
+    the top level anyway. If a brace is never closed, the blocks after it
+    are hidden, so the scan is repeated from the next line starting with a
+    block head like '@article{'.
+
+    Parameters
+    ----------
+    content: bytes
+        Content of a .bib file
+
+    Returns
+    -------
+    offsets: list of int
+        Offsets of the '@' characters
+    """
+    candidates = find_blocks(content)
+    offsets = []
+    start = 0
+    while start < len(candidates):
+        depth = 0
+        previous = candidates[start]
+        counted = False     # Braces of the current block are counted
+        last = start        # Candidate of the current block
+        for n in range(start, len(candidates)):
+            offset = candidates[n]
+            if counted:
+                depth += count_braces(content[previous:offset])
+            previous = offset
+            if depth <= 0:
+                offsets.append(offset)
+                depth = 0
+                counted = not is_comment_block(content, offset)
+                last = n
+        if counted:
+            depth += count_braces(content[previous:])
+        if depth <= 0:
+            break
+
+        # Brace opened in the last block was never closed
+        start = next((n for n in range(last + 1, len(candidates))
+                      if BLOCK_TYPE.match(content, candidates[n])), len(candidates))
+    return offsets
+
+
+def is_comment_block(content, offset):
+    """
+    Check if block at given offset is a comment.
+
+    Parameters
+    ----------
+    content: bytes
+    offset: int
+        Offset of the '@' character
+
+    Returns
+    -------
+    bool
+    """
+    return content[offset + 1:offset + 8].lower() == b"comment"
+
+
+def is_string_block(content, offset):
+    """
+    Check if block at given offset is a string definition.
+
+    Parameters
+    ----------
+    content: bytes
+    offset: int
+        Offset of the '@' character
+
+    Returns
+    -------
+    bool
+    """
+    return content[offset + 1:offset + 7].lower() == b"string"
+
+
+def split_chunks(content, size, first_size=None):
+    """
+    Split content of a .bib file into chunks of whole blocks that can be
+    parsed independently.
+
+    Parameters
+    ----------
+    content: bytes
+        Content of a .bib file
+    size: int
+        Minimum size of a chunk in bytes
+    first_size: int, optional
+        Minimum size of the first chunk. Use a small first chunk to show the
+        first entries quickly. Defaults to size.
+
+    Returns
+    -------
+    chunks: list of (int, int)
+        Start and end offsets of all chunks
+    """
+    if first_size is None:
+        first_size = size
+
+    chunks = []
+    start = 0
+    for offset in find_top_level_blocks(content):
+        if offset - start >= (size if chunks else first_size):
+            chunks.append((start, offset))
+            start = offset
+    chunks.append((start, len(content)))
+
+    return chunks
+
+
+def find_string_blocks(content):
+    """
+    Extract all string definitions from the content of a .bib file.
+
+    Parameters
+    ----------
+    content: bytes
+        Content of a .bib file
+
+    Returns
+    -------
+    bytes
+        Concatenated string blocks
+    """
+    blocks = []
+    offsets = find_top_level_blocks(content)
+    for offset, end in zip(offsets, offsets[1:] + [len(content)]):
+        if is_string_block(content, offset):
+            blocks.append(content[offset:end])
+    return b"\n".join(blocks)
+
+
+def scan_blocks(content):
+    """
+    Find byte range, type and key of all blocks that are not enclosed in
+    braces. This is a single pass over the content, no block is parsed.
+
+    Parameters
+    ----------
+    content: bytes or mmap
+        Content of a .bib file
+
+    Returns
+    -------
+    blocks: list of (int, int, str, str)
+        Start offset, end offset, lower case type and key of all blocks. The
+        key of strings, comments and preambles is meaningless.
+
+    Raises
+    ------
+    UnicodeDecodeError
+        If a type or key is not valid UTF-8
+    """
+    blocks = []
+    offsets = find_top_level_blocks(content)
+    for start, end in zip(offsets, offsets[1:] + [len(content)]):
+        match = BLOCK_HEAD.match(content, start, end)
+        if match:
+            blocktype, key = match.groups()
+            blocks.append((start, end, blocktype.decode().lower(), key.decode()))
+    return blocks
+
+
+def hash_block(block):
+    """
+    Hash a block, ignoring surrounding whitespace. Used to detect which
+    entries of a file changed on disk.
+
+    Parameters
+    ----------
+    block: bytes
+
+    Returns
+    -------
+    bytes
+    """
+    return blake2b(block.strip(), digest_size=16).digest()
@@ -0,0 +1,1011 @@
+# search_index.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from re import compile as re_compile
+
+from threading import Lock
+
+from array import array
+
+from bisect import bisect_left
+from bisect import bisect_right
+
+from .config_manager import field_dict
+
+from .customization import unicode_to_ascii
+
+from .bibitem import get_raw_text
+
+
+# Length of substrings that are indexed
+GRAM_SIZE = 3
+
+# Rebuild index once this fraction of items was modified, see SearchIndex.stale
+STALE_FRACTION = 0.25
+
+# Query fields that are not named like the field they refer to
+FIELD_ALIASES = {"type": "ENTRYTYPE", "key": "ID", "id": "ID"}
+
+# Fields that accept ranges like year:2015..2020
+NUMERIC_FIELDS = ("year", "date")
+
+# Fields in which words like schrodnger~ find similar words, see IndexTables.similar
+FUZZY_FIELDS = ("author", "editor", "title")
+
+# Minimum similarity of similar words, see get_similarity
+FUZZY_THRESHOLD = 0.4
+
+# Score of matches whose field starts with a search word, see SearchIndex.rank
+FIELD_WEIGHTS = {"ID": 4, "title": 3, "author": 3, "editor": 2, "journal": 2, "booktitle": 2}
+
+# Words that can be used as field in a query, like author:smith
+QUERY_FIELDS = set(field_dict) | set(FIELD_ALIASES) | set(NUMERIC_FIELDS)
+
+# Terms of a query: optional field, followed by a phrase in quotes or a word
+QUERY_TERM = re_compile(r'(?:(\w+):)?(?:"([^"]*)"(~?)|(\S+))')
+
+# Range of numeric field with optional bounds
+RANGE = re_compile(r"(\d*)\.\.(\d*)$")
+
+# Tokens are runs of letters and digits
+TOKEN = re_compile(r"\w+")
+
+# Numeric value of a field is its first number, for example, the year of a date
+NUMBER = re_compile(r"\d+")
+
+
+class SearchCancelled(Exception):
+    """Search was cancelled or is outdated"""
+
+
+class FuzzyWord(str):
+    """Word of a query that also matches similar words, like schrodnger~"""
+    def __eq__(self, other):
+        return isinstance(other, FuzzyWord) and str.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = str.__hash__
+
+
+def get_grams(text):
+    """
+    Get all substrings of length GRAM_SIZE of a text.
+
+    Parameters
+    ----------
+    text: str
+
+    Returns
+    -------
+    grams: set of str
+        Substrings of text. Shorter texts are a gram on their own.
+    """
+    if len(text) < GRAM_SIZE:
+        return {text} if text else set()
+    return {text[n:n + GRAM_SIZE] for n in range(len(text) - GRAM_SIZE + 1)}
+
+
+def get_padded_grams(token):
+    # Padding marks start and end of token, and gives short tokens grams
+    return get_grams(f" {token} ")
+
+
+def get_similarity(word, token):
+    """
+    Get similarity of two words, the Dice coefficient of their grams.
+
+    Parameters
+    ----------
+    word: str
+    token: str
+
+    Returns
+    -------
+    similarity: float
+        1 for equal words, 0 if they have no gram in common
+    """
+    grams = get_padded_grams(word)
+    token_grams = get_padded_grams(token)
+    return 2 * len(grams & token_grams) / (len(grams) + len(token_grams))
+
+
+def get_tokens(text):
+    """
+    Split text into tokens.
+
+    Parameters
+    ----------
+    text: str
+
+    Returns
+    -------
+    tokens: list of str
+    """
+    return TOKEN.findall(text)
+
+
+def get_field_texts(item, entry, field):
+    """
+    Get the texts of a field that are searched. Item caches are not written,
+    so that this can run in the search thread.
+
+    Parameters
+    ----------
+    item: BadaBibItem
+    entry: dict
+        Copy of the entry of item, see BadaBibItem.peek_entry
+    field: str
+
+    Returns
+    -------
+    texts: set of str
+        Lowercase raw and pretty text of field, and pretty text without
+        accents. Empty if field does not exist.
+    """
+    if field not in entry:
+        return set()
+    pretty = item.peek_pretty_field(entry, field) or ""
+    texts = (get_raw_text(entry, field) or "", pretty, unicode_to_ascii(pretty))
+    return {text.lower() for text in texts}
+
+
+def get_numeric_value(texts):
+    """
+    Get the numeric value of a field, see NUMERIC_FIELDS.
+
+    Parameters
+    ----------
+    texts: set of str
+        Texts of field, see get_field_texts
+
+    Returns
+    -------
+    value: int or None
+        First number in the texts, None if there is none
+    """
+    for text in sorted(texts):
+        match = NUMBER.search(text)
+        if match:
+            return int(match.group())
+    return None
+
+
+def is_range(value):
+    return isinstance(value, tuple)
+
+
+def is_fuzzy(value):
+    return isinstance(value, FuzzyWord)
+
+
+def is_phrase(word):
+    """Check if a field term has to appear as a whole, see field_matches"""
+    tokens = get_tokens(word)
+    return len(tokens) != 1 or tokens[0] != word
+
+
+def parse_query(query):
+    """
+    Split search query into terms. Terms are words, phrases in quotes, or
+    either of them prefixed by a field, like author:smith or
+    journal:"phys. rev". Numeric fields accept ranges like year:2015..2020,
+    where either bound may be omitted. Words with colons that do not start
+    with a known field, like arXiv:2101.00001, are searched as they are.
+    Words and phrases followed by a tilde, like schrodnger~, also match
+    similar words in FUZZY_FIELDS, regardless of accents.
+
+    Parameters
+    ----------
+    query: str
+
+    Returns
+    -------
+    terms: list of (str or None, str or tuple)
+        Field, or None for all fields, and lowercase word or phrase. Ranges
+        are tuples of lower and upper bound, each an int or None. Words that
+        match similar words are FuzzyWords without accents.
+    """
+    terms = []
+    for match in QUERY_TERM.finditer(query.lower()):
+        field, phrase, tilde, word = match.groups()
+        if phrase is None:
+            tilde = word.endswith("~")
+            word = word.rstrip("~")
+        value = phrase if phrase is not None else word.strip('"')
+        if field is not None and field not in QUERY_FIELDS:
+            value = f"{field}:{value}"
+            field = None
+        if not value:
+            continue
+
+        field = FIELD_ALIASES.get(field, field)
+        if tilde and (field is None or field in FUZZY_FIELDS):
+            value = FuzzyWord(unicode_to_ascii(value))
+            if get_tokens(value):
+                terms.append((field, value))
+            continue
+
+        if field in NUMERIC_FIELDS:
+            bounds = RANGE.match(value)
+            if bounds:
+                low, high = bounds.groups()
+                if not low and not high:
+                    continue
+                value = (int(low) if low else None, int(high) if high else None)
+        terms.append((field, value))
+    return terms
+
+
+def get_fuzzy_terms(terms):
+    """
+    Turn the words and phrases of a query into FuzzyWords where possible.
+
+    Parameters
+    ----------
+    terms: list of tuple
+        Terms of query, see parse_query
+
+    Returns
+    -------
+    fuzzy_terms: list of tuple
+    """
+    fuzzy_terms = []
+    for field, value in terms:
+        if not is_range(value) and (field is None or field in FUZZY_FIELDS):
+            fuzzy_value = FuzzyWord(unicode_to_ascii(value))
+            if get_tokens(fuzzy_value):
+                value = fuzzy_value
+        fuzzy_terms.append((field, value))
+    return fuzzy_terms
+
+
+def is_refinement(terms, new_terms):
+    """
+    Check if a query is at least as strict as another one. This is the case
+    if every term of the other query is part of a term of the query, for
+    example, after typing another character or word.
+
+    Parameters
+    ----------
+    terms: list of tuple
+        Terms of previous query, see parse_query
+    new_terms: list of tuple
+        Terms of new query
+
+    Returns
+    -------
+    bool
+        True if all items matching new_terms also match terms
+    """
+    def refines(term, new_term):
+        field, value = term
+        new_field, new_value = new_term
+        if field is not None and field != new_field:
+            return False
+        if is_range(value) or is_range(new_value) or is_fuzzy(value) or is_fuzzy(new_value):
+            return value == new_value
+        # Field terms match the start of tokens, see field_matches
+        if field is not None:
+            return new_value.startswith(value)
+        return value in new_value
+
+    return all(any(refines(term, new_term) for new_term in new_terms) for term in terms)
+
+
+def item_contains(item, word):
+    """
+    Check if word appears in the raw or pretty text of any field of item.
+
+    Parameters
+    ----------
+    item: BadaBibItem
+    word: str
+        Lowercase word or phrase
+
+    Returns
+    -------
+    bool
+    """
+    entry = item.peek_entry()
+    for field in entry:
+        for text in get_field_texts(item, entry, field):
+            if word in text:
+                return True
+    return False
+
+
+def field_matches(item, field, word):
+    """
+    Check if every token of word starts a token in a field of item. Phrases
+    and words with punctuation also have to appear in the field as a whole.
+
+    Parameters
+    ----------
+    item: BadaBibItem
+    field: str
+    word: str
+        Lowercase word or phrase
+
+    Returns
+    -------
+    bool
+    """
+    texts = get_field_texts(item, item.peek_entry(), field)
+    tokens = {token for text in texts for token in get_tokens(text)}
+    for word_token in get_tokens(word):
+        if not any(token.startswith(word_token) for token in tokens):
+            return False
+    return not is_phrase(word) or any(word in text for text in texts)
+
+
+def fuzzy_matches(item, fields, word):
+    """
+    Check if every token of word starts, or is similar to, a token in one of
+    the fields of item.
+
+    Parameters
+    ----------
+    item: BadaBibItem
+    fields: tuple of str
+    word: str
+        Lowercase word or phrase without accents
+
+    Returns
+    -------
+    bool
+    """
+    entry = item.peek_entry()
+    texts = {text for field in fields for text in get_field_texts(item, entry, field)}
+    tokens = {token for text in texts for token in get_tokens(text)}
+    for word_token in get_tokens(word):
+        if not any(token.startswith(word_token)
+                   or get_similarity(word_token, token) >= FUZZY_THRESHOLD
+                   for token in tokens):
+            return False
+    return True
+
+
+def value_in_range(item, field, bounds):
+    """
+    Check if the numeric value of a field of item is within bounds.
+
+    Parameters
+    ----------
+    item: BadaBibItem
+    field: str
+        One of NUMERIC_FIELDS
+    bounds: tuple
+        Lower and upper bound, each an int or None
+
+    Returns
+    -------
+    bool
+    """
+    value = get_numeric_value(get_field_texts(item, item.peek_entry(), field))
+    low, high = bounds
+    if value is None:
+        return False
+    return (low is None or value >= low) and (high is None or value <= high)
+
+
+def search_files(bibfiles, query, limit, is_cancelled=None):
+    """
+    Search all items of several files and rank the matches, see
+    SearchIndex.search and SearchIndex.rank. If nothing matches, similar
+    words are searched instead, see get_fuzzy_terms.
+
+    Parameters
+    ----------
+    bibfiles: list of BadaBibFile
+    query: str
+    limit: int
+        Maximum number of matches to return
+    is_cancelled: function, optional
+        Returns True if the search is no longer needed. The default value is
+        None.
+
+    Returns
+    -------
+    items: list of BadaBibItem
+        Best matches of all files, best match first
+    n_matches: int
+        Number of all matches
+
+    Raises
+    ------
+    SearchCancelled
+        If the search was cancelled or the items of a file were modified
+        while its index was built
+    """
+    def search_all(terms):
+        ranked = []
+        for bibfile in bibfiles:
+            # File was closed in the meantime
+            index = bibfile.index
+            if index.bibfile is None:
+                continue
+            matches = index.search_terms(terms, is_cancelled=is_cancelled)
+            if not matches:
+                continue
+            scores = index.rank(terms, matches)
+            ranked += [(-score, item.shallow_entry["ID"].lower(), bibfile.name, item)
+                       for item, score in scores.items() if not item.deleted]
+        return ranked
+
+    terms = parse_query(query)
+    if not terms:
+        return [], 0
+
+    ranked = search_all(terms)
+    fuzzy_terms = get_fuzzy_terms(terms)
+    if not ranked and fuzzy_terms != terms:
+        ranked = search_all(fuzzy_terms)
+    ranked.sort(key=lambda match: match[:3])
+    return [match[3] for match in ranked[:limit]], len(ranked)
+
+
+class IndexTables:
+    """
+    Postings of a search index, see SearchIndex. Postings are only ever
+    appended, so that a search can read them while items are modified.
+    """
+    def __init__(self):
+        self.grams = {}             # Numbers of items by gram, in any field
+        self.tokens = {}            # Numbers of items by token, by field
+        self.values = {}            # (value, number) of numeric fields, by field
+        self.similar = {}           # Tokens by padded gram, by field in FUZZY_FIELDS
+        self.vocabularies = {}      # Sorted tokens by field, for prefix search
+        self.sorted_values = {}     # Sorted values of numeric fields, by field
+
+    def add_field(self, number, item, entry, field):
+        """
+        Add the grams, tokens and numeric value of a field of an item.
+
+        Parameters
+        ----------
+        number: int
+            Number of item in index
+        item: BadaBibItem
+        entry: dict
+            Entry of item, see get_field_texts
+        field: str
+        """
+        texts = get_field_texts(item, entry, field)
+        for gram in {gram for text in texts for gram in get_grams(text)}:
+            posting = self.grams.get(gram)
+            if posting is None:
+                posting = self.grams[gram] = array("I")
+            # Fields of an item are added one after another, skip grams that
+            # are already posted for it by another field
+            if not posting or posting[-1] != number:
+                posting.append(number)
+
+        field_tokens = self.tokens.setdefault(field, {})
+        for token in {token for text in texts for token in get_tokens(text)}:
+            posting = field_tokens.get(token)
+            if posting is None:
+                posting = field_tokens[token] = array("I")
+                if field in FUZZY_FIELDS:
+                    similar = self.similar.setdefault(field, {})
+                    for gram in get_padded_grams(token):
+                        similar.setdefault(gram, []).append(token)
+            posting.append(number)
+
+        if field in NUMERIC_FIELDS:
+            value = get_numeric_value(texts)
+            if value is not None:
+                self.values.setdefault(field, []).append((value, number))
+
+    def get_vocabulary(self, field):
+        # Tokens are never removed, a vocabulary is outdated if it is shorter
+        field_tokens = self.tokens.get(field, {})
+        vocabulary = self.vocabularies.get(field)
+        if vocabulary is None or len(vocabulary) != len(field_tokens):
+            vocabulary = self.vocabularies[field] = sorted(field_tokens)
+        return vocabulary
+
+    def get_sorted_values(self, field):
+        # Values are never removed, sorted values are outdated if shorter
+        values = self.values.get(field, [])
+        sorted_values = self.sorted_values.get(field)
+        if sorted_values is None or len(sorted_values) != len(values):
+            sorted_values = self.sorted_values[field] = sorted(values)
+        return sorted_values
+
+    def lookup_prefix(self, field, prefix):
+        """
+        Find items with a token in field that starts with prefix.
+
+        Parameters
+        ----------
+        field: str
+        prefix: str
+
+        Returns
+        -------
+        numbers: set of int
+        """
+        field_tokens = self.tokens.get(field, {})
+        vocabulary = self.get_vocabulary(field)
+        numbers = set()
+        n = bisect_left(vocabulary, prefix)
+        while n < len(vocabulary) and vocabulary[n].startswith(prefix):
+            numbers.update(field_tokens[vocabulary[n]])
+            n += 1
+        return numbers
+
+    def lookup_similar(self, field, word):
+        """
+        Find items with a token in field that starts with word or is similar
+        to it, see get_similarity. Only tokens that share a gram with word
+        are compared to it.
+
+        Parameters
+        ----------
+        field: str
+            One of FUZZY_FIELDS
+        word: str
+            Single token without accents
+
+        Returns
+        -------
+        similarities: dict
+            Highest similarity of a token of each item to word
+        """
+        field_tokens = self.tokens.get(field, {})
+        grams = get_padded_grams(word)
+        shared = {}
+        for gram in grams:
+            for token in self.similar.get(field, {}).get(gram, ()):
+                shared[token] = shared.get(token, 0) + 1
+
+        # Tokens need at least this many grams in common to be similar enough
+        min_shared = FUZZY_THRESHOLD * len(grams) / (2 - FUZZY_THRESHOLD)
+        similarities = {}
+        for token, n_shared in shared.items():
+            if n_shared < min_shared:
+                continue
+            similarity = 2 * n_shared / (len(grams) + len(get_padded_grams(token)))
+            if similarity < FUZZY_THRESHOLD:
+                continue
+            for number in field_tokens[token]:
+                if similarity > similarities.get(number, 0):
+                    similarities[number] = similarity
+
+        # Tokens starting with word, like while typing, match even if short
+        for number in self.lookup_prefix(field, word):
+            similarities.setdefault(number, FUZZY_THRESHOLD)
+        return similarities
+
+    def lookup_range(self, field, bounds):
+        """
+        Find items whose numeric value of field is within bounds.
+
+        Parameters
+        ----------
+        field: str
+        bounds: tuple
+            Lower and upper bound, each an int or None
+
+        Returns
+        -------
+        numbers: set of int
+        """
+        sorted_values = self.get_sorted_values(field)
+        low, high = bounds
+        start = 0
+        stop = len(sorted_values)
+        if low is not None:
+            start = bisect_left(sorted_values, (low, -1))
+        if high is not None:
+            stop = bisect_right(sorted_values, (high, float("inf")))
+        return {number for _, number in sorted_values[start:stop]}
+
+    def lookup_word(self, word):
+        """
+        Find items containing all grams of a word in any field.
+
+        Parameters
+        ----------
+        word: str
+
+        Returns
+        -------
+        numbers: set of int
+        """
+        if len(word) < GRAM_SIZE:
+            # Short words match every gram that contains them
+            numbers = set()
+            # Grams may be added by the main thread, copy them first
+            for gram, posting in list(self.grams.items()):
+                if word in gram:
+                    numbers.update(posting)
+            return numbers
+
+        # Intersect postings of all grams, starting with the shortest
+        postings = sorted((self.grams.get(gram, ()) for gram in get_grams(word)), key=len)
+        numbers = set(postings[0])
+        for posting in postings[1:]:
+            if not numbers:
+                break
+            numbers.intersection_update(posting)
+        return numbers
+
+
+class SearchIndex:
+    """
+    Index of the items of a file for the search of the itemlist. It maps
+    all substrings of length GRAM_SIZE in the raw and pretty fields to the
+    items containing them, maps the tokens of each field to the items
+    containing them, and keeps the values of numeric fields sorted for range
+    queries. Candidates for a search term are found in the index, only those
+    that are not certain to match are compared to the term.
+
+    The index is built on the first search and kept up to date by the items
+    afterwards. Postings of modified fields are added, but outdated postings
+    are not removed. Modified items are therefore always compared to the
+    terms. Deleted items stay in the index, since they can be restored.
+    They are hidden by the filter of the itemlist.
+    """
+    def __init__(self, bibfile):
+        """
+        Initialize SearchIndex.
+
+        Parameters
+        ----------
+        bibfile: BadaBibFile
+            File whose items are indexed
+        """
+        self.bibfile = bibfile
+        self.tables = None      # Postings, None until index is built
+        self.items = []         # Indexed items by number
+        self.numbers = {}       # Number of each indexed item
+        self.stale = set()      # Numbers of items modified after they were indexed
+        self.generation = 0     # Incremented whenever the items change
+        self.lock = Lock()      # Held while the items change or a built index is installed
+
+    @property
+    def built(self):
+        """True if the index was built and is kept up to date"""
+        return self.tables is not None
+
+    def unref(self):
+        """Delete references to file and items to force-free memory"""
+        with self.lock:
+            self.bibfile = None
+            self.tables = None
+            self.items = []
+            self.numbers = {}
+
+    def build(self, is_cancelled=None):
+        """
+        Index all items of the file. Scanned entries are parsed, but not
+        kept. The index can be built in a worker thread, it is only used once
+        it is complete.
+
+        Parameters
+        ----------
+        is_cancelled: function, optional
+            Returns True if the index is no longer needed, for example, when
+            the application quits. The default value is None.
+
+        Raises
+        ------
+        SearchCancelled
+            If building was cancelled, the file was closed, or the items were
+            modified while the index was built
+        """
+        generation = self.generation
+        tables = IndexTables()
+        items = list(self.bibfile.items)
+        for number, item in enumerate(items):
+            if self.bibfile is None or (is_cancelled and is_cancelled()):
+                raise SearchCancelled
+            entry = item.peek_entry()
+            for field in entry:
+                tables.add_field(number, item, entry, field)
+
+        # Items must not change between the check and the install, they
+        # would be missing from the index
+        numbers = {item: number for number, item in enumerate(items)}
+        with self.lock:
+            if generation != self.generation or self.bibfile is None:
+                raise SearchCancelled
+            self.items = items
+            self.numbers = numbers
+            self.stale = set()
+            self.tables = tables
+
+    def prebuild(self, is_cancelled=None):
+        """
+        Build the index ahead of the first search, unless the file was closed.
+
+        Parameters
+        ----------
+        is_cancelled: function, optional
+            Returns True if the index is no longer needed, see build. The
+            default value is None.
+        """
+        if self.bibfile is not None and not self.built:
+            self.build(is_cancelled)
+
+    def add_item(self, item):
+        """
+        Add new item to index.
+
+        Parameters
+        ----------
+        item: BadaBibItem
+        """
+        with self.lock:
+            if self.built:
+                number = len(self.items)
+                self.items.append(item)
+                self.numbers[item] = number
+                for field in item.entry:
+                    self.tables.add_field(number, item, item.entry, field)
+            self.generation += 1
+
+    def mark_stale(self, number):
+        self.stale.add(number)
+        # Drop index if too many items need to be compared, rebuild on next search
+        if len(self.stale) > STALE_FRACTION * len(self.items):
+            self.tables = None
+
+    def update_item(self, item):
+        """
+        Re-index all fields of an item, for example, after its entry was
+        replaced.
+
+        Parameters
+        ----------
+        item: BadaBibItem
+        """
+        with self.lock:
+            if self.built and item in self.numbers:
+                number = self.numbers[item]
+                for field in item.entry:
+                    self.tables.add_field(number, item, item.entry, field)
+                self.mark_stale(number)
+            self.generation += 1
+
+    def update_field(self, item, field):
+        """
+        Re-index a single field of an item.
+
+        Parameters
+        ----------
+        item: BadaBibItem
+        field: str
+        """
+        with self.lock:
+            if self.built and item in self.numbers:
+                number = self.numbers[item]
+                self.tables.add_field(number, item, item.entry, field)
+                self.mark_stale(number)
+            self.generation += 1
+
+    @staticmethod
+    def find(term, tables, items, stale, candidates=None, is_cancelled=None):
+        """
+        Find items matching a search term.
+
+        Parameters
+        ----------
+        term: tuple
+            Field and word, phrase or range, see parse_query
+        tables: IndexTables
+            Postings of index
+        items: list of BadaBibItem
+            Indexed items by number
+        stale: set of int
+            Numbers of modified items
+        candidates: set of int, optional
+            Only consider these items. The default value is None.
+        is_cancelled: function, optional
+            Returns True if the search is no longer needed. The default value
+            is None.
+
+        Returns
+        -------
+        numbers: set of int
+            Numbers of matching items
+
+        Raises
+        ------
+        SearchCancelled
+            If is_cancelled returned True
+        """
+        field, value = term
+
+        if is_fuzzy(value):
+            fields = FUZZY_FIELDS if field is None else (field,)
+            numbers = None
+            for token in get_tokens(value):
+                token_numbers = set()
+                for fuzzy_field in fields:
+                    token_numbers.update(tables.lookup_similar(fuzzy_field, token))
+                numbers = token_numbers if numbers is None else numbers & token_numbers
+                if not numbers:
+                    break
+            exact = True
+
+            def matches(item):
+                return fuzzy_matches(item, fields, value)
+        elif field is None:
+            numbers = tables.lookup_word(value)
+            # Grams of long words may be spread over a field
+            exact = len(value) <= GRAM_SIZE
+
+            def matches(item):
+                return item_contains(item, value)
+        elif is_range(value):
+            numbers = tables.lookup_range(field, value)
+            exact = True
+
+            def matches(item):
+                return value_in_range(item, field, value)
+        else:
+            tokens = get_tokens(value)
+            numbers = tables.lookup_prefix(field, tokens[0]) if tokens else set()
+            for token in tokens[1:]:
+                if not numbers:
+                    break
+                numbers &= tables.lookup_prefix(field, token)
+            exact = not is_phrase(value)
+
+            def matches(item):
+                return field_matches(item, field, value)
+
+        if candidates is not None:
+            numbers &= candidates
+
+        # Modified items may no longer contain their postings
+        unverified = numbers & stale if exact else numbers
+        rejected = set()
+        for number in unverified:
+            if is_cancelled and is_cancelled():
+                raise SearchCancelled
+            if not matches(items[number]):
+                rejected.add(number)
+        return numbers - rejected
+
+    def search(self, query, candidates=None, is_cancelled=None):
+        """
+        Find items matching all terms of a search query, see parse_query.
+        This function can run in a worker thread while the items are
+        modified. The result is outdated if the generation of the index
+        changed in the meantime.
+
+        Parameters
+        ----------
+        query: str
+        candidates: set of BadaBibItem, optional
+            Only consider these items, for example, the matches of a less
+            strict query. The default value is None.
+        is_cancelled: function, optional
+            Returns True if the search is no longer needed, see find. The
+            default value is None.
+
+        Returns
+        -------
+        items: set of BadaBibItem or None
+            Matching items, None if query is empty
+
+        Raises
+        ------
+        SearchCancelled
+            If the search was cancelled or the index changed while it was
+            built
+        """
+        return self.search_terms(parse_query(query), candidates, is_cancelled)
+
+    def search_terms(self, terms, candidates=None, is_cancelled=None):
+        """
+        Find items matching all terms of a parsed search query, see search.
+
+        Parameters
+        ----------
+        terms: list of tuple
+            Terms of query, see parse_query
+        candidates: set of BadaBibItem, optional
+            Only consider these items. The default value is None.
+        is_cancelled: function, optional
+            Returns True if the search is no longer needed. The default value
+            is None.
+
+        Returns
+        -------
+        items: set of BadaBibItem or None
+            Matching items, None if there are no terms
+
+        Raises
+        ------
+        SearchCancelled
+            If the search was cancelled or the index changed while it was
+            built
+        """
+        if not terms:
+            return None
+
+        if not self.built:
+            self.build(is_cancelled)
+
+        # The index may be dropped or rebuilt while searching
+        tables = self.tables
+        items = self.items
+        stale = set(self.stale)
+        if tables is None:
+            raise SearchCancelled
+
+        numbers = None
+        if candidates is not None:
+            numbers = {self.numbers[item] for item in candidates if item in self.numbers}
+
+        # Start with fields and long words, they usually have fewer candidates
+        def priority(term):
+            field, value = term
+            return (field is None or is_fuzzy(value), 0 if is_range(value) else -len(value))
+
+        for term in sorted(terms, key=priority):
+            numbers = self.find(term, tables, items, stale, numbers, is_cancelled)
+            if not numbers:
+                break
+        return {items[number] for number in numbers}
+
+    def rank(self, terms, items):
+        """
+        Score the matches of a search query. Each word of the query scores
+        the weight of every field in FIELD_WEIGHTS in which it starts a token.
+        Similar words score the weight times their similarity instead.
+
+        Parameters
+        ----------
+        terms: list of tuple
+            Terms of query, see parse_query
+        items: set of BadaBibItem
+            Matches of query, see search_terms
+
+        Returns
+        -------
+        scores: dict
+            Score of each item
+        """
+        scores = dict.fromkeys(items, 0)
+        tables = self.tables
+        if tables is None:
+            return scores
+
+        numbers = {self.numbers[item]: item for item in items if item in self.numbers}
+        for field, value in terms:
+            if is_range(value):
+                continue
+            tokens = get_tokens(value)
+            if not tokens:
+                continue
+            for weighted_field, weight in FIELD_WEIGHTS.items():
+                if field is not None and field != weighted_field:
+                    continue
+                if is_fuzzy(value) and weighted_field in FUZZY_FIELDS:
+                    similarities = tables.lookup_similar(weighted_field, tokens[0])
+                    for number in similarities.keys() & numbers.keys():
+                        scores[numbers[number]] += weight * similarities[number]
+                    continue
+                for number in tables.lookup_prefix(weighted_field, tokens[0]) & numbers.keys():
+                    scores[numbers[number]] += weight
+        return scores
@@ -14,15 +14,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from os import cpu_count
 from os.path import split
 from os.path import exists
+from os.path import getsize
 
 from shutil import copyfile
 
-from bibtexparser.bparser import BibTexParser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from multiprocessing import get_context
+
 from bibtexparser.bwriter import BibTexWriter
 from bibtexparser.bibdatabase import BibDatabase
-from bibtexparser.customization import homogenize_latex_encoding
 
 from .config_manager import get_homogenize_latex
 from .config_manager import get_homogenize_fields
@@ -33,6 +39,18 @@ from .config_manager import get_create_backup
 
 from .bibfile import BadaBibFile
 
+from .loader import parse_chunk
+from .loader import parse_entry
+from .loader import SCAN_SIZE
+from .loader import read_file
+from .loader import read_strings
+from .loader import rescan_file
+from .loader import save_chunks
+from .loader import scan_file
+
+from .search_index import SearchCancelled
+from .search_index import search_files
+
 
 BACKUP_TAG = "% Bada Bib! Backup File"
 
@@ -91,16 +109,14 @@ class BadaBibStore:
         self.bibfiles = {}
         self.string_files = {}
         self.global_strings = {}
+        self.executor = None
+        self.entry_executor = None
+        self.search_executor = None
+        self.searches = set()           # Searches that are queued or running
 
     @staticmethod
-    def get_default_parser():
-        parser = BibTexParser(interpolate_strings=False,
-                              ignore_nonstandard_types=False)
-        if get_homogenize_latex():
-            parser.customization = homogenize_latex_encoding
-        if get_homogenize_fields():
-            parser.homogenize_fields = True
-        return parser
+    def get_parser_settings():
+        return get_homogenize_latex(), get_homogenize_fields()
 
     @staticmethod
     def get_default_writer():
@@ -109,40 +125,172 @@ class BadaBibStore:
         writer.indent = get_field_indent() * " "
         return writer
 
-    def add_file(self, name):
+    @staticmethod
+    def new_process_pool(max_workers):
+        # Parsing is pure Python and does not benefit from threads, use
+        # processes instead. Spawn fresh interpreters, forking a running GTK
+        # application is not safe.
+        try:
+            return ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("spawn"))
+        except (ImportError, NotImplementedError, OSError):
+            # Platform does not support process pools, fall back to threads
+            return ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_executor(self):
+        # One process per core for whole files
+        if self.executor is None:
+            self.executor = self.new_process_pool(cpu_count())
+        return self.executor
+
+    def get_entry_executor(self):
+        # Entries are parsed while typing, a process of their own keeps them
+        # from waiting behind whole files
+        if self.entry_executor is None:
+            self.entry_executor = self.new_process_pool(1)
+        return self.entry_executor
+
+    def submit(self, function, *args):
+        # A worker process that died leaves the pool broken, start a new one
+        try:
+            return self.get_executor().submit(function, *args)
+        except BrokenProcessPool:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            return self.get_executor().submit(function, *args)
+
+    def get_search_executor(self):
+        # Searching works on the items in memory, a single thread evaluates
+        # one query after another
+        if self.search_executor is None:
+            self.search_executor = ThreadPoolExecutor(max_workers=1)
+        return self.search_executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.entry_executor is not None:
+            self.entry_executor.shutdown(wait=False, cancel_futures=True)
+            self.entry_executor = None
+        if self.search_executor is not None:
+            self.search_executor.shutdown(wait=False, cancel_futures=True)
+            self.search_executor = None
+
+    def read_file(self, name, sort_fields):
+        return self.submit(read_file, name, self.get_parser_settings(), sort_fields)
+
+    def scan_file(self, name):
+        return self.submit(scan_file, name, self.get_parser_settings())
+
+    @staticmethod
+    def is_large_file(name):
+        try:
+            return getsize(name) >= SCAN_SIZE
+        except OSError:
+            return False
+
+    def rescan_file(self, name):
+        known = self.bibfiles[name].get_source_hashes()
+        return self.submit(rescan_file, name, self.get_parser_settings(), known)
+
+    def parse_entry(self, bibtex):
+        try:
+            return self.get_entry_executor().submit(parse_entry, bibtex,
+                                                    self.get_parser_settings())
+        except BrokenProcessPool:
+            self.entry_executor.shutdown(wait=False, cancel_futures=True)
+            self.entry_executor = None
+            return self.get_entry_executor().submit(parse_entry, bibtex,
+                                                    self.get_parser_settings())
+
+    def submit_search(self, function, *args):
+        # Keep track of searches, so that index builds can give way to them
+        future = self.get_search_executor().submit(function, *args)
+        self.searches.add(future)
+        future.add_done_callback(self.searches.discard)
+        return future
+
+    def search_file(self, bibfile, query, candidates=None, is_cancelled=None):
+        return self.submit_search(bibfile.index.search, query, candidates, is_cancelled)
+
+    def build_index(self, bibfile):
+        # Build the index at low priority. Stop building as soon as a search
+        # is waiting and build again after it. Also stop once the executor is
+        # shut down, so that quitting does not wait for it.
+        executor = self.get_search_executor()
+
+        def is_cancelled():
+            return self.search_executor is not executor or bool(self.searches)
+
+        def requeue(future):
+            if (not future.cancelled() and isinstance(future.exception(), SearchCancelled)
+                    and self.search_executor is executor and bibfile.index.bibfile is not None):
+                self.build_index(bibfile)
+
+        future = executor.submit(bibfile.index.prebuild, is_cancelled)
+        future.add_done_callback(requeue)
+        return future
+
+    def search_all_files(self, query, limit, is_cancelled=None):
+        bibfiles = list(self.bibfiles.values())
+        return self.submit_search(search_files, bibfiles, query, limit, is_cancelled)
+
+    def parse_chunk(self, chunk):
+        return self.submit(parse_chunk, chunk)
+
+    def save_chunks(self, name, key, payloads):
+        return self.submit(save_chunks, name, key, payloads)
+
+    def add_file(self, name, database, sort_values=None, hashes=None, stamp=None, spans=None):
         # check if file is already open
         if name in self.bibfiles:
             return ["file_open"]
 
-        try:
-            # try parsing
-            with open(name) as bibtex_file:
-                parser = self.get_default_parser()
-                try:
-                    database = parser.parse_file(bibtex_file)
-                except UnicodeDecodeError:
-                    return ["error", "parse_error"]
-
-            # initialize bibfile
-            bibfile = BadaBibFile(self, name, database)
-            self.bibfiles[name] = bibfile
-            self.update_global_strings(bibfile)
-            self.update_short_names()
-
-            # remove backup tags, if present
-            while BACKUP_TAG in database.comments:
-                database.comments.remove(BACKUP_TAG)
-
-            # check if file contain bibtex entries
-            if len(bibfile.database.entries) == 0:
-                bibfile.backup_on_save = False
-                return ["empty"]
-
-            return []
+        # initialize bibfile
+        bibfile = BadaBibFile(self, name, database, sort_values=sort_values, hashes=hashes)
 
-        except OSError:
+        # entries of scanned files are parsed on demand
+        if spans is not None and not bibfile.open_source(stamp, spans):
             return ["error", "file_error"]
 
+        self.bibfiles[name] = bibfile
+        self.update_global_strings(bibfile)
+        self.update_short_names()
+
+        # remove backup tags, if present
+        while BACKUP_TAG in database.comments:
+            database.comments.remove(BACKUP_TAG)
+
+        return []
+
+    def extend_file(self, name, database, sort_values=None, hashes=None):
+        bibfile = self.bibfiles[name]
+        items = bibfile.extend_database(database, sort_values, hashes)
+        self.update_global_strings(bibfile)
+        return items
+
+    def reload_file(self, name, database, entries):
+        bibfile = self.bibfiles[name]
+
+        # remove backup tags, if present
+        while BACKUP_TAG in database.comments:
+            database.comments.remove(BACKUP_TAG)
+
+        result = bibfile.reload_database(database, entries)
+        self.update_global_strings(bibfile)
+        return result
+
+    def finish_file(self, name):
+        bibfile = self.bibfiles[name]
+        bibfile.loading = False
+
+        # check if file contain bibtex entries
+        if len(bibfile.database.entries) == 0:
+            bibfile.backup_on_save = False
+            return ["empty"]
+
+        return []
+
     def rename_file(self, old_name, new_name):
         bibfile = self.bibfiles.pop(old_name)
         bibfile.update_filename(new_name)
@@ -159,7 +307,10 @@ class BadaBibStore:
             name = f"{basename} {n}.bib"
             n += 1
 
+        # Entries are bound to the strings of the file, which include the
+        # month abbreviations like in parsed files
         database = BibDatabase()
+        database.load_common_strings()
         bibfile = BadaBibFile(self, name, database, created=True)
         self.bibfiles[name] = bibfile
         self.update_short_names()
@@ -170,6 +321,11 @@ class BadaBibStore:
         bibfile = self.bibfiles[name]
         errors = []
 
+        # scanned entries are read from the file that is about to be overwritten
+        if not bibfile.read_entries():
+            return ["save"]
+        bibfile.close_source()
+
         # create backup, if desired
         backup = True
         if get_create_backup() and bibfile.backup_on_save:
@@ -188,6 +344,9 @@ class BadaBibStore:
                 file.truncate()
         except OSError:
             errors.append("save")
+        else:
+            # remember what was written to detect changes on disk
+            bibfile.update_source_hashes()
 
         return errors
 
@@ -206,20 +365,16 @@ class BadaBibStore:
 
     def import_strings(self, filename):
         if filename not in self.string_files:
-            try:
-                with open(filename) as string_file:
-                    parser = self.get_default_parser()
-                    try:
-                        database = parser.parse_file(string_file)
-                        if len(database.strings) == 0:
-                            return "empty"
-                        self.string_files[filename] = database.strings
-                        self.update_global_strings()
-                        return "success"
-                    except UnicodeDecodeError:
-                        return "parse_error"
-            except OSError:
+            status, strings = read_strings(filename, self.get_parser_settings())
+            if "file_error" in status:
                 return "file_error"
+            if "parse_error" in status:
+                return "parse_error"
+            if len(strings) == 0:
+                return "empty"
+            self.string_files[filename] = strings
+            self.update_global_strings()
+            return "success"
         else:
             return "success"
 
@@ -235,9 +390,9 @@ class BadaBibStore:
         else:
             bibfiles = self.bibfiles.values()
         for file in bibfiles:
-            file.database.strings = {**self.global_strings, **file.local_strings}
+            file.set_strings({**self.global_strings, **file.local_strings})
 
     def update_file_strings(self, name, strings):
         file = self.bibfiles[name]
         file.local_strings = strings
-        file.database.strings = {**self.global_strings, **file.local_strings}
+        file.set_strings({**self.global_strings, **file.local_strings})
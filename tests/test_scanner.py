@@ -0,0 +1,83 @@
+# test_scanner.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# The scanner does not depend on GTK, run with
+# python -m unittest discover tests
+
+
+import sys
+import unittest
+
+from os.path import dirname
+from os.path import join
+
+sys.path.insert(0, join(dirname(dirname(__file__)), "src"))
+
+from scanner import find_blocks                 # noqa: E402
+from scanner import find_top_level_blocks       # noqa: E402
+from scanner import scan_blocks                 # noqa: E402
+from scanner import split_chunks                # noqa: E402
+
+
+# Entry with a line in its abstract that looks like the head of a block
+NESTED = b"""@article{a,
+  title = {First},
+  abstract = {Cited as
+@inproceedings{x, title = {Nested}}
+in the proceedings},
+}
+@book{b, title = {Second}}
+"""
+
+
+def get_types(content):
+    return [(blocktype, key) for _start, _end, blocktype, key in scan_blocks(content)]
+
+
+class TestScanner(unittest.TestCase):
+    def test_nested_block_head(self):
+        self.assertEqual(get_types(NESTED), [("article", "a"), ("book", "b")])
+
+    def test_nested_block_head_span(self):
+        start, end, _blocktype, _key = scan_blocks(NESTED)[0]
+        self.assertIn(b"in the proceedings", NESTED[start:end])
+
+    def test_nested_block_head_chunks(self):
+        # Chunks are only cut between whole entries
+        for start, end in split_chunks(NESTED, 1):
+            self.assertEqual(NESTED[start:end].count(b"{") - NESTED[start:end].count(b"}"), 0)
+
+    def test_nested_block_head_is_detected(self):
+        # Callers compare both counts to fall back to the parser
+        self.assertNotEqual(len(find_top_level_blocks(NESTED)), len(find_blocks(NESTED)))
+
+    def test_unbalanced_comment(self):
+        content = b"% header {unbalanced\n@comment{a { b}\n@article{a, title={t}}\n"
+        self.assertEqual(get_types(content), [("comment", "a"), ("article", "a")])
+
+    def test_unclosed_brace(self):
+        content = (b"@article{a, title={open\n}\n"
+                   b"@book{b, title={t}}\n"
+                   b"@misc{c, note={z}}\n")
+        self.assertEqual(get_types(content), [("article", "a"), ("book", "b"), ("misc", "c")])
+
+    def test_extra_closing_brace(self):
+        content = b"@article{a, title={t}}}\n@book{b, title={t}}\n"
+        self.assertEqual(get_types(content), [("article", "a"), ("book", "b")])
+
+
+if __name__ == "__main__":
+    unittest.main()